@@ -0,0 +1,622 @@
+import os
+import re
+import json
+import time
+import wave
+import math
+import random
+import shutil
+import struct
+import asyncio
+import hashlib
+import argparse
+import logging
+import platform
+import tempfile
+import threading
+import importlib
+from urllib.parse import urlparse, parse_qs
+
+# Offline benchmark: runs the bot logic from main.py against local stand-ins for yt-dlp, Spotify,
+# Discord voice and the audio CDN, and writes the results as JSON so runs can be compared.
+#
+#   python benchmark.py --guilds 200 --output results.json
+
+FRAME_SECONDS = 0.02
+PCM_FRAME = b'\0' * 3840
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline benchmark for the music bot")
+    parser.add_argument('--guilds', type=int, default=100, help="guilds that /play a single track")
+    parser.add_argument('--unique-tracks', type=int, default=0, help="distinct tracks requested by those guilds (default: half of --guilds)")
+    parser.add_argument('--playlist-guilds', type=int, default=10, help="guilds that /play a Spotify playlist")
+    parser.add_argument('--playlist-size', type=int, default=250)
+    parser.add_argument('--play-seconds', type=float, default=10.0, help="how long the single-track guilds keep streaming")
+    parser.add_argument('--track-seconds', type=int, default=30, help="duration of the served audio")
+    parser.add_argument('--control-presses', type=int, default=20, help="control button presses per guild")
+    parser.add_argument('--ydl-latency', type=float, default=0.3, help="mean fake yt-dlp extraction time in seconds")
+    parser.add_argument('--ydl-failure-rate', type=float, default=0.02)
+    parser.add_argument('--spotify-latency', type=float, default=0.1, help="mean fake Spotify API call time in seconds")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='benchmark_results.json')
+    return parser.parse_args()
+
+def prepare_environment():
+    # main.py reads its configuration at import time; the fakes need the in-process thread backend
+    os.environ.setdefault('DISCORD_TOKEN', 'benchmark')
+    os.environ.setdefault('SPOTIFY_CLIENT_ID', 'benchmark')
+    os.environ.setdefault('SPOTIFY_CLIENT_SECRET', 'benchmark')
+    os.environ['EXTRACTOR_BACKEND'] = 'thread'
+    os.environ['RESOLUTION_CACHE_DB'] = ':memory:'
+    os.environ['SPOTIFY_MATCH_DB'] = ':memory:'
+    os.environ['SHARED_STATE_DB'] = ''
+    os.environ['METRICS_PORT'] = '0'
+    os.environ['QUEUE_JOURNAL_DIR'] = ''
+    os.environ.pop('SHARD_COUNT', None)
+
+def percentiles(values):
+    if not values:
+        return {'count': 0}
+    ordered = sorted(values)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+    return {'count': len(ordered), 'avg': sum(ordered) / len(ordered), 'p50': pick(0.5), 'p95': pick(0.95), 'max': ordered[-1]}
+
+# Local audio server
+
+def write_test_audio(path, seconds):
+    with wave.open(path, 'wb') as output:
+        output.setnchannels(2)
+        output.setsampwidth(2)
+        output.setframerate(48000)
+        period = [int(8000 * math.sin(2 * math.pi * 440 * i / 48000)) for i in range(48000 // 440 * 4)]
+        frames = b''.join(struct.pack('<hh', sample, sample) for sample in period)
+        total = seconds * 48000
+        chunk = frames * (48000 // len(period) + 1)
+        written = 0
+        while written < total:
+            count = min(total - written, len(chunk) // 4)
+            output.writeframes(chunk[:count * 4])
+            written += count
+
+class AudioServer:
+    # Serves one WAV file over HTTP (with range support) in its own thread, so it does not load the bot's event loop
+    def __init__(self, path):
+        self.path = path
+        self.port = None
+        self.loop = None
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='audio-server', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        self.ready.wait()
+        return f"http://127.0.0.1:{self.port}/audio.wav"
+
+    def run(self):
+        from aiohttp import web
+        self.loop = asyncio.new_event_loop()
+        app = web.Application()
+        app.router.add_get('/audio.wav', lambda request: web.FileResponse(self.path))
+        runner = web.AppRunner(app, access_log=None)
+        self.loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        self.loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        self.ready.set()
+        self.loop.run_forever()
+
+# Fake yt-dlp and Spotify
+
+class FakeBackends:
+    def __init__(self, args, audio_url):
+        self.args = args
+        self.audio_url = audio_url
+        self.random = random.Random(args.seed)
+        self.lock = threading.Lock()
+        self.ydl_calls = 0
+        self.ydl_failures = 0
+        self.spotify_calls = 0
+
+    def delay(self, mean):
+        with self.lock:
+            value = self.random.uniform(0.5 * mean, 1.5 * mean)
+        time.sleep(value)
+
+    def should_fail(self):
+        with self.lock:
+            return self.random.random() < self.args.ydl_failure_rate
+
+    def video(self, video_id, title):
+        return {
+            'id': video_id,
+            'title': title,
+            'url': f"{self.audio_url}?id={video_id}&duration={self.args.track_seconds}",
+            'duration': self.args.track_seconds,
+            'webpage_url': f"https://www.youtube.com/watch?v={video_id}",
+            'acodec': 'pcm_s16le',
+            'ext': 'wav',
+        }
+
+def video_id_for(text):
+    return hashlib.sha1(text.encode()).hexdigest()[:11]
+
+def make_fake_youtube_dl(backends, download_error):
+    class FakeYoutubeDL:
+        def __init__(self, options):
+            self.options = self.params = options
+
+        def close(self):
+            pass
+
+        def extract_info(self, url, download=False):
+            with backends.lock:
+                backends.ydl_calls += 1
+            backends.delay(backends.args.ydl_latency)
+            if backends.should_fail():
+                with backends.lock:
+                    backends.ydl_failures += 1
+                raise download_error(f"ERROR: [benchmark] {url}: simulated extraction failure")
+            params = parse_qs(urlparse(url).query)
+            if 'list' in params and self.options.get('extract_flat'):
+                return self.playlist(params)
+            video_id = params.get('v', [video_id_for(url)])[0]
+            return backends.video(video_id, f"Benchmark track {video_id}")
+
+        def playlist(self, params):
+            size = int(params.get('size', ['100'])[0])
+            first, _, last = (self.options.get('playlist_items') or f'1-{size}').partition('-')
+            start, stop = int(first) - 1, min(size, int(last) if last else size)
+            playlist_id = params['list'][0]
+            entries = []
+            for i in range(start, stop):
+                video_id = video_id_for(f"{playlist_id}/{i}")
+                entries.append({'id': video_id, 'title': f"Playlist track {i}", 'url': f"https://www.youtube.com/watch?v={video_id}"})
+            return {'id': playlist_id, 'title': 'Benchmark playlist', 'entries': entries}
+
+    return FakeYoutubeDL
+
+class FakeSpotify:
+    # Mirrors the spotipy calls used by main.py; playlist ids look like bench<size>x<n>
+    def __init__(self, backends):
+        self.backends = backends
+
+    def call(self):
+        with self.backends.lock:
+            self.backends.spotify_calls += 1
+        self.backends.delay(self.backends.args.spotify_latency)
+
+    def track_data(self, track_id):
+        return {
+            'id': track_id,
+            'name': f"Song {track_id}",
+            'duration_ms': self.backends.args.track_seconds * 1000,
+            'external_ids': {'isrc': f"BENCH{track_id}"},
+            'artists': [{'name': f"Artist {int(hashlib.sha1(track_id.encode()).hexdigest(), 16) % 50}"}],
+        }
+
+    def track(self, track_id):
+        self.call()
+        return self.track_data(track_id)
+
+    def playlist(self, playlist_id, fields=None):
+        self.call()
+        size = int(re.match(r'bench(\d+)', playlist_id).group(1))
+        return {'snapshot_id': f"{playlist_id}-1", 'tracks': {'total': size}}
+
+    def playlist_items(self, playlist_id, limit=100, offset=0, fields=None, additional_types=None):
+        self.call()
+        size = int(re.match(r'bench(\d+)', playlist_id).group(1))
+        return {'items': [{'track': self.track_data(f"{playlist_id}t{i}")} for i in range(offset, min(size, offset + limit))]}
+
+# Fake audio sources, used when FFmpeg is not installed
+
+def make_silent_audio(discord):
+    class SilentAudio(discord.AudioSource):
+        def __init__(self, source, *args, before_options='', **kwargs):
+            params = parse_qs(urlparse(source).query)
+            offset = re.search(r'-ss ([\d.]+)', before_options or '')
+            seconds = float(params.get('duration', ['30'])[0]) - (float(offset.group(1)) if offset else 0.0)
+            self.remaining = max(0, int(seconds / FRAME_SECONDS))
+
+        def read(self):
+            if self.remaining <= 0:
+                return b''
+            self.remaining -= 1
+            return PCM_FRAME
+
+    class SilentOpusAudio(SilentAudio):
+        def read(self):
+            return b'\xf8\xff\xfe' if super().read() else b''
+
+        def is_opus(self):
+            return True
+
+    return SilentAudio, SilentOpusAudio
+
+# Fake Discord objects
+
+class FakeAvatar:
+    url = 'https://cdn.discordapp.com/embed/avatars/0.png'
+
+class FakeVoiceState:
+    def __init__(self, channel):
+        self.channel = channel
+
+class FakeMember:
+    def __init__(self, member_id, channel, bot=False):
+        self.id = member_id
+        self.name = f"user{member_id}"
+        self.bot = bot
+        self.voice = FakeVoiceState(channel)
+        self.avatar = None
+        self.default_avatar = FakeAvatar()
+
+class FakeMessage:
+    def __init__(self, bench):
+        self.bench = bench
+
+    async def edit(self, **kwargs):
+        self.bench.message_edits += 1
+
+    async def delete(self):
+        pass
+
+class FakeFollowup:
+    def __init__(self, bench):
+        self.bench = bench
+
+    async def send(self, content=None, **kwargs):
+        self.bench.messages.append(content)
+        return FakeMessage(self.bench)
+
+class FakeResponse:
+    def __init__(self, bench):
+        self.bench = bench
+        self.done = False
+
+    async def defer(self, **kwargs):
+        self.done = True
+
+    async def send_message(self, content=None, **kwargs):
+        self.done = True
+        self.bench.messages.append(content)
+
+    async def edit_message(self, **kwargs):
+        self.done = True
+        self.bench.message_edits += 1
+
+    async def send_modal(self, modal):
+        self.done = True
+
+class FakeInteraction:
+    def __init__(self, bench, guild, user):
+        self.guild = guild
+        self.user = user
+        self.channel_id = None
+        self.response = FakeResponse(bench)
+        self.followup = FakeFollowup(bench)
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.name = f"guild{guild_id}"
+
+class FakeChannel:
+    def __init__(self, bench, guild):
+        self.bench = bench
+        self.guild = guild
+        self.id = guild.id
+        self.name = f"voice{guild.id}"
+        self.members = []
+
+    async def connect(self):
+        import discord
+        voice_clients = self.bench.bot.client._connection._voice_clients
+        if self.guild.id in voice_clients:
+            raise discord.ClientException('Already connected to a voice channel.')
+        vc = voice_clients[self.guild.id] = FakeVoiceClient(self.bench, self.guild, self)
+        return vc
+
+class FakePlayer(threading.Thread):
+    # Consumes the source in real time on its own thread, like discord.py's AudioPlayer
+    def __init__(self, vc, source, after):
+        super().__init__(name=f"player-{vc.guild.id}", daemon=True)
+        self.vc = vc
+        self.source = source
+        self.after = after
+        self.ended = threading.Event()
+        self.resumed = threading.Event()
+        self.resumed.set()
+        self.error = None
+
+    def run(self):
+        try:
+            start = time.perf_counter()
+            loops = 0
+            while not self.ended.is_set():
+                if not self.resumed.is_set():
+                    self.resumed.wait()
+                    start = time.perf_counter()
+                    loops = 0
+                    continue
+                data = self.source.read()
+                if not data:
+                    break
+                self.vc.bench.frame_played(self.vc.guild.id, data, self.source)
+                loops += 1
+                delay = start + FRAME_SECONDS * loops - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.ended.set()
+            if self.after:
+                try:
+                    self.after(self.error)
+                except Exception as e:
+                    logging.error(f"Benchmark after callback failed: {e}")
+            self.source.cleanup()
+
+class FakeVoiceClient:
+    def __init__(self, bench, guild, channel):
+        self.bench = bench
+        self.guild = guild
+        self.channel = channel
+        self.player = None
+        self.connected = True
+
+    def play(self, source, *, after=None, **kwargs):
+        import discord
+        if self.player and not self.player.ended.is_set():
+            raise discord.ClientException('Already playing audio.')
+        self.player = FakePlayer(self, source, after)
+        self.player.start()
+
+    def is_connected(self):
+        return self.connected
+
+    def is_playing(self):
+        return bool(self.player and not self.player.ended.is_set() and self.player.resumed.is_set())
+
+    def is_paused(self):
+        return bool(self.player and not self.player.ended.is_set() and not self.player.resumed.is_set())
+
+    def pause(self):
+        if self.player:
+            self.player.resumed.clear()
+
+    def resume(self):
+        if self.player:
+            self.player.resumed.set()
+
+    def stop(self):
+        if self.player:
+            self.player.ended.set()
+            self.player.resumed.set()
+            self.player = None
+
+    @property
+    def source(self):
+        return self.player.source if self.player else None
+
+    @source.setter
+    def source(self, value):
+        self.player.source = value
+
+    async def disconnect(self, force=False):
+        self.stop()
+        self.connected = False
+        self.bench.bot.client._connection._voice_clients.pop(self.guild.id, None)
+
+# Benchmark driver
+
+class Benchmark:
+    def __init__(self, args, bot, backends):
+        self.args = args
+        self.bot = bot
+        self.backends = backends
+        self.messages = []
+        self.message_edits = 0
+        self.requested = {}
+        self.first_audio = {}
+        self.frames = 0
+        self.opus_encoder = None
+
+    def frame_played(self, guild_id, data, source):
+        if guild_id not in self.first_audio:
+            self.first_audio[guild_id] = time.perf_counter()
+        self.frames += 1
+        if self.opus_encoder and not source.is_opus():
+            # The real player encodes PCM on the voice thread, so its CPU cost belongs in the measurement
+            self.opus_encoder.encode(data, self.opus_encoder.SAMPLES_PER_FRAME)
+
+    def new_guild(self, guild_id, user_id):
+        guild = FakeGuild(guild_id)
+        channel = FakeChannel(self, guild)
+        user = FakeMember(user_id, channel)
+        channel.members.append(user)
+        return guild, user
+
+    async def play(self, guild, user, url):
+        self.requested[guild.id] = time.perf_counter()
+        await self.bot.play.callback(FakeInteraction(self, guild, user), url)
+
+    async def single_tracks(self):
+        unique = self.args.unique_tracks or max(1, self.args.guilds // 2)
+        guilds = [self.new_guild(1000 + i, 1) for i in range(self.args.guilds)]
+        started = time.perf_counter()
+        await asyncio.gather(*(self.play(guild, user, f"benchmark song {i % unique}") for i, (guild, user) in enumerate(guilds)))
+        enqueue_seconds = time.perf_counter() - started
+        cpu_start = time.process_time()
+        frames_start = self.frames
+        await asyncio.sleep(self.args.play_seconds)
+        cpu = time.process_time() - cpu_start
+        stream_seconds = (self.frames - frames_start) * FRAME_SECONDS
+        ttfa = [self.first_audio[guild.id] - self.requested[guild.id] for guild, _ in guilds if guild.id in self.first_audio]
+        return guilds, {
+            'guilds': len(guilds),
+            'unique_tracks': unique,
+            'started_streams': len(ttfa),
+            'time_to_first_audio': percentiles(ttfa),
+            'play_requests_per_second': len(guilds) / enqueue_seconds if enqueue_seconds else None,
+            'process_cpu_percent_per_stream': 100 * cpu / stream_seconds if stream_seconds else None,
+            'streamed_seconds': stream_seconds,
+        }
+
+    async def playlists(self):
+        guilds = [self.new_guild(5000 + i, 2) for i in range(self.args.playlist_guilds)]
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            self.play(guild, user, f"https://open.spotify.com/playlist/bench{self.args.playlist_size}x{i}")
+            for i, (guild, user) in enumerate(guilds)
+        ))
+        first_page_seconds = time.perf_counter() - started
+        deadline = time.perf_counter() + 120
+        while time.perf_counter() < deadline:
+            sessions = [self.bot.sessions.get(guild.id) for guild, _ in guilds]
+            if all(session is None or session.playlist_load is None or session.playlist_load.done for session in sessions):
+                break
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+        queued = sum(len(self.bot.sessions[guild.id].queue) + 1 for guild, _ in guilds if guild.id in self.bot.sessions)
+        return guilds, {
+            'guilds': len(guilds),
+            'playlist_size': self.args.playlist_size,
+            'first_page_seconds': first_page_seconds,
+            'total_seconds': elapsed,
+            'tracks_queued': queued,
+            'enqueue_tracks_per_second': queued / elapsed if elapsed else None,
+        }
+
+    async def controls(self, guilds):
+        view = self.bot.MusicControls()
+        handlers = ['queue_button', 'volume_up_button', 'volume_down_button', 'pause_button', 'resume_button']
+        latencies = {name: [] for name in handlers}
+        started = time.perf_counter()
+        for _ in range(self.args.control_presses):
+            for guild, user in guilds:
+                for name in handlers:
+                    interaction = FakeInteraction(self, guild, user)
+                    press = time.perf_counter()
+                    await getattr(view, name).callback(interaction)
+                    latencies[name].append(time.perf_counter() - press)
+        elapsed = time.perf_counter() - started
+        presses = sum(len(values) for values in latencies.values())
+        return {
+            'presses': presses,
+            'presses_per_second': presses / elapsed if elapsed else None,
+            'latency': {name: percentiles(values) for name, values in latencies.items()},
+        }
+
+    async def leave(self, guilds):
+        for guild, _ in guilds:
+            await self.bot.leave_guild(guild.id)
+            vc = self.bot.client._connection._voice_clients.get(guild.id)
+            if vc:
+                await vc.disconnect()
+
+    async def run(self):
+        bot = self.bot
+        await bot.client._async_setup_hook()
+
+        async def change_presence(**kwargs):
+            pass
+        bot.client.change_presence = change_presence
+
+        rss_start = bot.read_rss()
+        single_guilds, single = await self.single_tracks()
+        playlist_guilds, playlists = await self.playlists()
+        report = bot.memory_report()
+        session_bytes = list(report['sessions'].values())
+        rss_loaded = bot.read_rss()
+        controls = await self.controls(single_guilds[:20])
+        await self.leave(single_guilds + playlist_guilds)
+        await asyncio.sleep(0.5)
+
+        streams = {
+            mode: {
+                'streams': totals['streams'],
+                'seconds': totals['seconds'],
+                'python_cpu_percent': 100 * totals['python_cpu'] / totals['seconds'] if totals['seconds'] else None,
+                'ffmpeg_cpu_percent': 100 * totals['ffmpeg_cpu'] / totals['seconds'] if totals['seconds'] else None,
+            }
+            for mode, totals in bot.stream_cpu_totals.items()
+        }
+        guild_count = len(single_guilds) + len(playlist_guilds)
+        return {
+            'single_tracks': single,
+            'playlists': playlists,
+            'controls': controls,
+            'cpu_per_stream': streams,
+            'memory': {
+                'rss_start': rss_start,
+                'rss_loaded': rss_loaded,
+                'rss_per_guild': (rss_loaded - rss_start) / guild_count if rss_start and rss_loaded and guild_count else None,
+                'session_bytes': percentiles(session_bytes),
+            },
+            'backends': {
+                'ydl_calls': self.backends.ydl_calls,
+                'ydl_failures': self.backends.ydl_failures,
+                'spotify_calls': self.backends.spotify_calls,
+                'duplicate_extractions_saved': bot.extraction_flights.saved,
+                'resolution_cache': bot.resolution_cache.stats(),
+                'extraction_scheduler': bot.extraction_scheduler.stats(),
+            },
+            'control_message_edits': self.message_edits,
+        }
+
+async def main():
+    args = parse_args()
+    prepare_environment()
+    bot = importlib.import_module('main')
+    logging.getLogger().setLevel(logging.WARNING)
+    import discord
+    import ydl_pool
+
+    workdir = tempfile.mkdtemp(prefix='musicbot-bench-')
+    try:
+        audio_path = os.path.join(workdir, 'audio.wav')
+        write_test_audio(audio_path, args.track_seconds)
+        audio_url = AudioServer(audio_path).start()
+
+        backends = FakeBackends(args, audio_url)
+        yt_dlp = ydl_pool.load_yt_dlp()
+        yt_dlp.YoutubeDL = make_fake_youtube_dl(backends, yt_dlp.utils.DownloadError)
+        bot.sp = FakeSpotify(backends)
+        ffmpeg = shutil.which('ffmpeg') is not None
+        if not ffmpeg:
+            logging.warning("FFmpeg not found: using silent in-process audio sources, FFmpeg CPU is not measured")
+            discord.FFmpegPCMAudio, discord.FFmpegOpusAudio = make_silent_audio(discord)
+
+        bench = Benchmark(args, bot, backends)
+        try:
+            if discord.opus.is_loaded() or discord.opus._load_default():
+                bench.opus_encoder = discord.opus.Encoder()
+        except Exception as e:
+            logging.warning(f"Opus encoder unavailable, PCM encoding cost is not measured: {e}")
+
+        results = await bench.run()
+        output = {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'config': vars(args),
+            'environment': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'ffmpeg': ffmpeg,
+                'opus_encoding': bench.opus_encoder is not None,
+                'playback_mode': bot.PLAYBACK_MODE,
+                'extractor_workers': bot.EXTRACTOR_WORKERS,
+            },
+            'results': results,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+        print(json.dumps(output['results'], indent=2))
+        print(f"Results saved to {args.output}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    asyncio.run(main())
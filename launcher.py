@@ -0,0 +1,68 @@
+import os
+import sys
+import time
+import signal
+import logging
+import subprocess
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Runs main.py in several processes, each with its own subset of shards, so the bot can use more than one core
+WORKERS = max(1, int(os.getenv('WORKERS', str(os.cpu_count() or 1))))
+SHARD_COUNT = max(WORKERS, int(os.getenv('SHARD_COUNT', str(WORKERS))))
+SHARED_STATE_DB = os.getenv('SHARED_STATE_DB', 'shared_state.db')
+WORKER_START_DELAY = 5  # Discord allows one shard identify every 5 seconds
+RESTART_DELAY = 10
+
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+
+workers = {}
+stopping = False
+
+def shard_ids(worker_id):
+    return list(range(worker_id, SHARD_COUNT, WORKERS))
+
+def start_worker(worker_id):
+    env = dict(os.environ)
+    env['WORKER_ID'] = str(worker_id)
+    env['SHARD_COUNT'] = str(SHARD_COUNT)
+    env['SHARD_IDS'] = ','.join(str(shard_id) for shard_id in shard_ids(worker_id))
+    env['SHARED_STATE_DB'] = SHARED_STATE_DB
+    workers[worker_id] = subprocess.Popen([sys.executable, MAIN_SCRIPT], env=env)
+    logging.info(f"Started worker {worker_id} (pid {workers[worker_id].pid}) with shards {env['SHARD_IDS']}")
+
+def stop_workers(signum, frame):
+    global stopping
+    stopping = True
+    for process in workers.values():
+        if process.poll() is None:
+            process.terminate()
+
+def main():
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+    logging.info(f"Launching {WORKERS} workers for {SHARD_COUNT} shards")
+    for worker_id in range(WORKERS):
+        if stopping:
+            break
+        start_worker(worker_id)
+        time.sleep(WORKER_START_DELAY * len(shard_ids(worker_id)))
+
+    while not stopping:
+        time.sleep(1)
+        for worker_id, process in list(workers.items()):
+            code = process.poll()
+            if code is not None and not stopping:
+                logging.error(f"Worker {worker_id} exited with code {code}, restarting in {RESTART_DELAY} s")
+                time.sleep(RESTART_DELAY)
+                if not stopping:
+                    start_worker(worker_id)
+
+    for process in workers.values():
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,27 @@
 import discord
 from discord import app_commands, ui, PartialEmoji, Activity, ActivityType
-import yt_dlp
 import asyncio
 import os
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
-from collections import deque
+from collections import deque, OrderedDict, namedtuple
+from urllib.parse import urlparse, parse_qs
 import logging
 import time
+import threading
+import hashlib
+import sys
+import sqlite3
+import re
+import json
+import heapq
+import math
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import ydl_pool
+import metrics
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Suppress warnings from yt-dlp and set custom headers
-yt_dlp.utils.std_headers['User-Agent'] = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36'
-yt_dlp.utils.std_headers['Accept-Language'] = 'en-US,en;q=0.9'
-yt_dlp.utils.std_headers['Accept'] = 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8'
-yt_dlp.utils.std_headers['Referer'] = 'https://www.youtube.com/'
-
 # Check Discord token
 token = os.getenv('DISCORD_TOKEN')
 if not token:
@@ -28,13 +32,40 @@ spotify_client_id = os.getenv('SPOTIFY_CLIENT_ID')
 spotify_client_secret = os.getenv('SPOTIFY_CLIENT_SECRET')
 if not spotify_client_id or not spotify_client_secret:
     raise ValueError("SPOTIFY_CLIENT_ID or SPOTIFY_CLIENT_SECRET is not set!")
-sp = spotipy.Spotify(auth_manager=SpotifyClientCredentials(client_id=spotify_client_id, client_secret=spotify_client_secret))
+sp = None
+sp_lock = threading.Lock()
+
+def get_spotify():
+    # spotipy is imported on the first Spotify request rather than at startup
+    global sp
+    with sp_lock:
+        if sp is None:
+            import spotipy
+            from spotipy.oauth2 import SpotifyClientCredentials
+            sp = spotipy.Spotify(auth_manager=SpotifyClientCredentials(client_id=spotify_client_id, client_secret=spotify_client_secret))
+    return sp
+
+# Settings for the Spotify metadata layer
+SPOTIFY_WORKERS = max(1, int(os.getenv('SPOTIFY_WORKERS', '4')))
+SPOTIFY_TRACK_CACHE_SIZE = int(os.getenv('SPOTIFY_TRACK_CACHE_SIZE', '10000'))
+SPOTIFY_PLAYLIST_CACHE_SIZE = int(os.getenv('SPOTIFY_PLAYLIST_CACHE_SIZE', '256'))
+SPOTIFY_PAGE_SIZE = 100
+SPOTIFY_TRACK_FIELDS = 'id,name,duration_ms,external_ids(isrc),artists(name)'
+SPOTIFY_MATCH_DB = os.getenv('SPOTIFY_MATCH_DB', 'spotify_matches.db')
+spotify_executor = ThreadPoolExecutor(max_workers=SPOTIFY_WORKERS, thread_name_prefix='spotify')
 
 # Configure intents
 intents = discord.Intents.default()
 intents.message_content = True
 intents.voice_states = True
-client = discord.Client(intents=intents)
+# Sharded deployment: launcher.py starts several worker processes, each running the shards listed in SHARD_IDS
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '0'))
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv('SHARD_IDS', '').split(',') if shard_id.strip()] or None
+WORKER_ID = os.getenv('WORKER_ID', '0')
+if SHARD_COUNT:
+    client = discord.AutoShardedClient(intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+else:
+    client = discord.Client(intents=intents)
 tree = app_commands.CommandTree(client)
 
 # Settings for yt-dlp and FFmpeg
@@ -74,223 +105,2086 @@ YDL_OPTIONS_SOUNDCLOUD_FULL = {
     'no_warnings': True,
     'cookiefile': 'soundcloud_cookies.txt',
 }
+# Playlists are listed page by page: the first page starts playback, the rest is queued in the background
+PLAYLIST_PAGE_SIZE = 100
+YDL_OPTION_SETS = {
+    'youtube': YDL_OPTIONS,
+    'youtube_full': YDL_OPTIONS_FULL,
+    'soundcloud': YDL_OPTIONS_SOUNDCLOUD,
+    'soundcloud_full': YDL_OPTIONS_SOUNDCLOUD_FULL,
+}
 FFMPEG_OPTIONS = {'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5', 'options': '-vn'}
 
+# Control message updates: bursts are coalesced, each message is edited at most once per interval,
+# and the total edit rate is capped to stay inside Discord's rate limit buckets
+CONTROL_UPDATE_DELAY = 1.0
+CONTROL_MIN_INTERVAL = 5.0
+CONTROL_EDITS_PER_SECOND = max(1, int(os.getenv('CONTROL_EDITS_PER_SECOND', '5')))
+
+# Presence updates are rate limited hard by the gateway, so changes are debounced and published at most once per interval
+PRESENCE_DEBOUNCE = 5.0
+PRESENCE_MIN_INTERVAL = float(os.getenv('PRESENCE_MIN_INTERVAL', '30'))
+
+# Gapless playback: the next track's FFmpeg process is started and buffered shortly before the current one ends.
+# PREBUFFER_MAX caps how many of these warm sources exist across all guilds (0 disables prebuffering)
+PREBUFFER_MAX = max(0, int(os.getenv('PREBUFFER_MAX', '0')))
+PREBUFFER_LEAD = float(os.getenv('PREBUFFER_LEAD', '10'))
+PREBUFFER_FRAMES = 50
+
+# A stream that ends this many seconds before its duration is treated as broken and resumed at its position
+STREAM_END_TOLERANCE = 5.0
+STREAM_RECOVERY_ATTEMPTS = 3
+STREAM_URL_MIN_TTL = 60  # Restarts and seeks re-resolve stream URLs expiring sooner than this
+
+# Seconds to wait after the last listener leaves before the bot disconnects
+AUTO_LEAVE_GRACE = max(0.0, float(os.getenv('AUTO_LEAVE_GRACE', '0')))
+
+# 'pcm' decodes in FFmpeg and encodes Opus in-process; 'opus' lets FFmpeg produce Opus packets directly
+PLAYBACK_MODE = os.getenv('PLAYBACK_MODE', 'pcm')
+
+# Extraction backend: 'thread' runs yt-dlp on a thread pool, 'process' moves it out of the main interpreter
+EXTRACTOR_BACKEND = os.getenv('EXTRACTOR_BACKEND', 'thread')
+EXTRACTOR_WORKERS = max(1, int(os.getenv('EXTRACTOR_WORKERS', '4')))
+# Never below the thread count: a thread waiting for an instance would still count as a running extraction
+YDL_POOL_SIZE = max(EXTRACTOR_WORKERS, int(os.getenv('YDL_POOL_SIZE', str(EXTRACTOR_WORKERS))))
+
+if EXTRACTOR_BACKEND == 'process':
+    # Each worker process only runs one extraction at a time, so one warm instance per option set is enough
+    extraction_executor = ydl_pool.start_process_pool(EXTRACTOR_WORKERS)
+else:
+    ydl_pool.configure(YDL_POOL_SIZE)
+    extraction_executor = ThreadPoolExecutor(max_workers=EXTRACTOR_WORKERS, thread_name_prefix='yt-dlp')
+
+# Extraction priorities: lower values are dispatched first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_PREFETCH = 1
+PRIORITY_BACKGROUND = 2
+EXTRACTION_CONCURRENCY = max(1, int(os.getenv('EXTRACTION_CONCURRENCY', str(EXTRACTOR_WORKERS))))
+EXTRACTION_BACKOFF_BASE = 2.0
+EXTRACTION_BACKOFF_MAX = 120.0
+THROTTLE_MARKERS = ('429', 'Too Many Requests', 'Sign in to confirm', 'rate-limit', 'rate limit')
+
+class ExtractionScheduler:
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.running = 0
+        # One round-robin ring of guilds per priority; each guild has its own FIFO of jobs
+        self.queues = [OrderedDict() for _ in range(PRIORITY_BACKGROUND + 1)]
+        self.backoff = 0.0
+        self.backoff_until = 0.0
+        self.backoff_handle = None
+        self.throttled = 0
+        self.completed = 0
+        self.waits = deque(maxlen=500)
+
+    async def run(self, guild_id, priority, options_name, url, playlist_items=None):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.queues[priority].setdefault(guild_id, deque()).append((future, options_name, url, playlist_items, loop.time()))
+        self.dispatch()
+        return await future
+
+    def next_job(self):
+        for ring in self.queues:
+            while ring:
+                guild_id, jobs = next(iter(ring.items()))
+                job = jobs.popleft()
+                if jobs:
+                    ring.move_to_end(guild_id)
+                else:
+                    del ring[guild_id]
+                if not job[0].done():
+                    return job
+        return None
+
+    def dispatch(self):
+        loop = asyncio.get_running_loop()
+        delay = self.backoff_until - loop.time()
+        if delay > 0:
+            if self.backoff_handle is None:
+                self.backoff_handle = loop.call_later(delay, self.resume)
+            return
+        while self.running < self.concurrency:
+            job = self.next_job()
+            if job is None:
+                return
+            self.running += 1
+            asyncio.create_task(self.execute(*job))
+
+    def resume(self):
+        self.backoff_handle = None
+        self.dispatch()
+
+    async def execute(self, future, options_name, url, playlist_items, queued_at):
+        loop = asyncio.get_running_loop()
+        self.waits.append(loop.time() - queued_at)
+        try:
+            result = await loop.run_in_executor(extraction_executor, ydl_pool.extract_info, options_name, YDL_OPTION_SETS[options_name], url, playlist_items)
+            self.backoff = self.backoff / 2 if self.backoff > EXTRACTION_BACKOFF_BASE else 0.0
+            if not future.done():
+                future.set_result(result)
+        except Exception as e:
+            if any(marker in str(e) for marker in THROTTLE_MARKERS):
+                self.throttled += 1
+                self.backoff = min(max(self.backoff * 2, EXTRACTION_BACKOFF_BASE), EXTRACTION_BACKOFF_MAX)
+                self.backoff_until = loop.time() + self.backoff
+                logging.warning(f"Extraction throttled by upstream, pausing extraction for {self.backoff:.0f} s")
+            if not future.done():
+                future.set_exception(e)
+        finally:
+            self.running -= 1
+            self.completed += 1
+            self.dispatch()
+
+    def stats(self):
+        waits = list(self.waits)
+        return {
+            'running': self.running,
+            'queued': [sum(len(jobs) for jobs in ring.values()) for ring in self.queues],
+            'completed': self.completed,
+            'throttled': self.throttled,
+            'backoff': self.backoff,
+            'avg_wait': sum(waits) / len(waits) if waits else 0.0,
+            'max_wait': max(waits, default=0.0),
+        }
+
+extraction_scheduler = ExtractionScheduler(EXTRACTION_CONCURRENCY)
+
+HOST_LIKE = re.compile(r'^[\w-]+(\.[\w-]+)+(:\d+)?(/\S*)?$')
+
+def normalize_source(url):
+    # Different spellings of the same video, track or search share one key
+    text = url.strip()
+    if '://' not in text and HOST_LIKE.match(text):
+        # A link pasted without its scheme (youtu.be/...) is still a URL, and video ids are case-sensitive
+        text = f"https://{text}"
+    parsed = urlparse(text)
+    if not parsed.scheme or not parsed.netloc:
+        return ' '.join(url.split()).casefold()
+    host = parsed.netloc.lower()
+    for prefix in ('www.', 'm.', 'music.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    if host in ('youtube.com', 'youtu.be'):
+        params = parse_qs(parsed.query)
+        video_id = parsed.path.strip('/') if host == 'youtu.be' else params.get('v', [''])[0]
+        playlist_id = params.get('list', [''])[0]
+        if video_id or playlist_id:
+            return f"youtube.com/watch?v={video_id}&list={playlist_id}"
+    if host == 'soundcloud.com':
+        return f"soundcloud.com{parsed.path.rstrip('/')}"
+    return url.strip()
+
+class SingleFlight:
+    # Concurrent calls with the same key share one in-progress call and all receive its result or error
+    def __init__(self):
+        self.inflight = {}
+        self.calls = 0
+        self.saved = 0
+
+    async def run(self, key, factory):
+        task = self.inflight.get(key)
+        if task is None:
+            self.calls += 1
+            task = self.inflight[key] = asyncio.ensure_future(factory())
+            task.add_done_callback(lambda done: self.finished(key, done))
+        else:
+            self.saved += 1
+            logging.info(f"Joined in-flight extraction for {key[1]} ({self.saved} duplicate extractions saved)")
+        # Shielded so a cancelled caller (e.g. a superseded prefetch) does not cancel it for the others
+        return await asyncio.shield(task)
+
+    def finished(self, key, task):
+        if self.inflight.get(key) is task:
+            del self.inflight[key]
+        if not task.cancelled():
+            task.exception()  # Marks the error as retrieved even if every caller went away
+
+    def stats(self):
+        return {'calls': self.calls, 'saved': self.saved, 'inflight': len(self.inflight)}
+
+extraction_flights = SingleFlight()
+
+async def timed_extraction(options_name, url, guild_id, priority, playlist_items):
+    with EXTRACTION_SECONDS.time(provider=options_name.split('_')[0], function=options_name):
+        return await extraction_scheduler.run(guild_id, priority, options_name, url, playlist_items)
+
+async def run_extraction(options_name, url, guild_id=None, priority=PRIORITY_INTERACTIVE, playlist_items=None):
+    return await extraction_flights.run(
+        (options_name, normalize_source(url), playlist_items),
+        lambda: timed_extraction(options_name, url, guild_id, priority, playlist_items),
+    )
+
+class LoopLagMonitor:
+    def __init__(self, interval=0.5, report_every=300):
+        self.interval = interval
+        self.report_every = report_every
+        self.samples = deque(maxlen=int(report_every / interval))
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        last_report = loop.time()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            now = loop.time()
+            self.samples.append(max(0.0, now - start - self.interval))
+            if now - last_report >= self.report_every:
+                last_report = now
+                stats = self.stats()
+                logging.info(f"Event loop lag ({EXTRACTOR_BACKEND} backend): avg {stats['avg'] * 1000:.1f} ms, p95 {stats['p95'] * 1000:.1f} ms, max {stats['max'] * 1000:.1f} ms")
+
+    def stats(self):
+        if not self.samples:
+            return {'avg': 0.0, 'p95': 0.0, 'max': 0.0}
+        ordered = sorted(self.samples)
+        return {
+            'avg': sum(ordered) / len(ordered),
+            'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+            'max': ordered[-1],
+        }
+
+loop_lag_monitor = LoopLagMonitor()
+loop_lag_task = None
+
+# Prometheus metrics on http://METRICS_HOST:METRICS_PORT/metrics (disabled when METRICS_PORT is 0).
+# Sharded workers listen on METRICS_PORT + worker id. METRICS_PROFILING=1 adds /profile?seconds=N
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PROFILING = os.getenv('METRICS_PROFILING', '0') == '1'
+metrics_runner = None
+
+def executor_backlog(executor):
+    if isinstance(executor, ProcessPoolExecutor):
+        return len(executor._pending_work_items)
+    return executor._work_queue.qsize()
+
+EXTRACTION_SECONDS = metrics.histogram('musicbot_extraction_seconds', 'Time to extract a track or playlist page, including scheduling', ('provider', 'function'))
+TIME_TO_FIRST_AUDIO = metrics.histogram('musicbot_time_to_first_audio_seconds', 'Time from /play to the first audio frame')
+RATE_LIMITED = metrics.counter('musicbot_discord_rate_limited_total', 'Discord REST and webhook responses with status 429', ('scope',))
+metrics.gauge('musicbot_ffmpeg_processes', 'Running FFmpeg processes', ('kind',), lambda: {
+    ('playback',): TrackedSource.open_count,
+    ('cache_download',): len(audio_cache.storing),
+})
+metrics.gauge('musicbot_voice_clients', 'Connected voice clients', (), lambda: {(): len(client.voice_clients)})
+metrics.gauge('musicbot_queue_depth', 'Tracks waiting in each guild queue', ('guild',), lambda: {
+    (str(guild_id),): len(session.queue) for guild_id, session in sessions.items()
+})
+metrics.gauge('musicbot_event_loop_lag_seconds', 'Event loop lag over the last report window', ('stat',), lambda: {
+    (stat,): value for stat, value in loop_lag_monitor.stats().items()
+})
+metrics.gauge('musicbot_executor_queue_length', 'Jobs waiting for an executor worker', ('executor',), lambda: {
+    ('extraction',): executor_backlog(extraction_executor),
+    ('spotify',): executor_backlog(spotify_executor),
+    **{(f'scheduler_priority_{priority}',): queued for priority, queued in enumerate(extraction_scheduler.stats()['queued'])},
+})
+metrics.gauge('musicbot_duplicate_extractions_saved', 'Extractions avoided by joining an identical in-flight one', (), lambda: {(): extraction_flights.saved})
+rate_limit_handler = metrics.RateLimitLogHandler(RATE_LIMITED)
+logging.getLogger('discord.http').addHandler(rate_limit_handler)
+logging.getLogger('discord.webhook.async_').addHandler(rate_limit_handler)
+
+# Settings for the stream URL resolution cache
+RESOLUTION_CACHE_DB = os.getenv('RESOLUTION_CACHE_DB', 'resolution_cache.db')
+RESOLUTION_CACHE_SIZE = int(os.getenv('RESOLUTION_CACHE_SIZE', '2048'))
+RESOLUTION_CACHE_DEFAULT_TTL = 1800  # Used when the stream URL carries no expire= parameter
+RESOLUTION_REFRESH_MARGIN = 600  # Entries expiring sooner than this are re-resolved by video id
+
+ResolvedTrack = namedtuple('ResolvedTrack', ['stream_url', 'title', 'duration', 'video_id', 'page_url', 'expires_at', 'acodec'])
+
+def get_stream_expiry(stream_url):
+    # googlevideo URLs carry the expiry either as a query parameter or as a /expire/<ts>/ path segment
+    parsed = urlparse(stream_url)
+    expire = parse_qs(parsed.query).get('expire', [None])[0]
+    if not expire:
+        match = re.search(r'/expire/(\d+)', parsed.path)
+        expire = match.group(1) if match else None
+    if expire and expire.isdigit():
+        return int(expire)
+    return int(time.time()) + RESOLUTION_CACHE_DEFAULT_TTL
+
+class ResolutionCache:
+    def __init__(self, path, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        # WAL and a busy timeout let the worker processes of a sharded deployment share the file
+        self.db = sqlite3.connect(path, timeout=5)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # The cache is disposable, so a table written by an older layout is simply recreated
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(resolutions)")]
+        if columns and columns != ['key', *ResolvedTrack._fields]:
+            self.db.execute("DROP TABLE resolutions")
+        self.db.execute(f"CREATE TABLE IF NOT EXISTS resolutions (key TEXT PRIMARY KEY, {', '.join(ResolvedTrack._fields)})")
+        self.db.execute("DELETE FROM resolutions WHERE expires_at <= ?", (int(time.time()),))
+        self.db.commit()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and entry.expires_at <= time.time():
+            # Another worker sharing the database may already have stored a fresher URL
+            self.entries.pop(key)
+            entry = None
+        if entry is None:
+            row = self.db.execute(
+                f"SELECT {', '.join(ResolvedTrack._fields)} FROM resolutions WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+            if row:
+                entry = ResolvedTrack(*row)
+                self._remember(key, entry)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        self._remember(key, entry)
+        self.db.execute(f"INSERT OR REPLACE INTO resolutions VALUES (?{', ?' * len(entry)})", (key, *entry))
+        self.db.commit()
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+        self.db.execute("DELETE FROM resolutions WHERE key = ?", (key,))
+        self.db.commit()
+
+    def _remember(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': len(self.entries),
+        }
+
+resolution_cache = ResolutionCache(RESOLUTION_CACHE_DB, RESOLUTION_CACHE_SIZE)
+
+# Optional on-disk Opus cache: tracks played at least AUDIO_CACHE_MIN_PLAYS times are downloaded once
+# and later played from disk. An empty AUDIO_CACHE_DIR disables it
+AUDIO_CACHE_DIR = os.getenv('AUDIO_CACHE_DIR', '')
+AUDIO_CACHE_MAX_MB = int(os.getenv('AUDIO_CACHE_MAX_MB', '1024'))
+AUDIO_CACHE_MIN_PLAYS = max(1, int(os.getenv('AUDIO_CACHE_MIN_PLAYS', '2')))
+AUDIO_CACHE_DOWNLOADS = 1
+AUDIO_CACHE_PART_MAX_AGE = 600  # a download that has not grown for this long belongs to a dead process
+
+class AudioCache:
+    def __init__(self, directory, max_bytes, min_plays):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_plays = min_plays
+        self.files = OrderedDict()  # key -> size, least recently played first
+        self.total_bytes = 0
+        self.play_counts = OrderedDict()
+        self.storing = set()
+        self.semaphore = asyncio.Semaphore(AUDIO_CACHE_DOWNLOADS)
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def scan(self):
+        # Rebuilds the index from the directory, which other workers may share: the byte budget covers all of
+        # them, and file mtimes give the LRU order
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+                if entry.name.endswith('.part'):
+                    # Left behind by an interrupted download; live downloads keep growing and are left alone
+                    if now - stat.st_mtime > AUDIO_CACHE_PART_MAX_AGE:
+                        os.remove(entry.path)
+                elif entry.name.endswith('.opus'):
+                    entries.append((stat.st_mtime, entry.name[:-5], stat.st_size))
+            except OSError:
+                pass
+        self.files = OrderedDict((key, size) for _, key, size in sorted(entries))
+        self.total_bytes = sum(self.files.values())
+
+    def load(self):
+        if self.directory:
+            self.scan()
+            self.evict()
+
+    def key(self, resolved):
+        if not self.directory or not resolved.video_id:
+            return None
+        return re.sub(r'[^A-Za-z0-9_-]', '_', str(resolved.video_id))
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.opus")
+
+    def lookup(self, resolved):
+        key = self.key(resolved)
+        if key is None:
+            return None
+        # Other workers may share the directory, so the file itself is the source of truth
+        path = self.path(key)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            if key in self.files:
+                self.total_bytes -= self.files.pop(key)
+            return None
+        if key not in self.files:
+            self.files[key] = size
+            self.total_bytes += size
+        return path
+
+    def played(self, resolved, cached):
+        key = self.key(resolved)
+        if key is None:
+            return
+        if cached:
+            self.hits += 1
+            # The entry may have been evicted since the source was opened
+            if key in self.files:
+                self.files.move_to_end(key)
+            # The file's mtime keeps the LRU order across restarts
+            try:
+                os.utime(self.path(key))
+            except OSError:
+                pass
+            return
+        self.misses += 1
+        count = self.play_counts.pop(key, 0) + 1
+        self.play_counts[key] = count
+        while len(self.play_counts) > 10000:
+            self.play_counts.popitem(last=False)
+        if count >= self.min_plays and key not in self.files and key not in self.storing:
+            self.storing.add(key)
+            asyncio.create_task(self.store(key, resolved))
+
+    async def store(self, key, resolved):
+        path = self.path(key)
+        part = f"{path}.{os.getpid()}.part"
+        try:
+            async with self.semaphore:
+                # Opus streams are only remuxed; everything else is encoded once here instead of on every play
+                codec = ['-c:a', 'copy'] if resolved.acodec == 'opus' else ['-c:a', 'libopus', '-b:a', '128k']
+                process = await asyncio.create_subprocess_exec(
+                    'ffmpeg', '-nostdin', '-loglevel', 'error', '-y', *FFMPEG_OPTIONS['before_options'].split(),
+                    '-i', resolved.stream_url, '-vn', *codec, '-f', 'opus', part,
+                    stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+                )
+                _, stderr = await process.communicate()
+            if process.returncode != 0:
+                logging.warning(f"Audio cache download failed for {resolved.title}: {stderr.decode(errors='replace').strip()}")
+                return
+            size = os.path.getsize(part)
+            if size > self.max_bytes:
+                return
+            os.replace(part, path)
+            self.stores += 1
+            self.scan()
+            self.evict()
+            stats = self.stats()
+            logging.info(
+                f"Audio cache stored {resolved.title} ({size / 1048576:.1f} MB): {stats['entries']} files, "
+                f"{stats['bytes'] / 1048576:.1f} MB, hit rate {stats['hit_rate']:.0%}"
+            )
+        except Exception as e:
+            logging.warning(f"Audio cache error for {resolved.title}: {e}")
+        finally:
+            self.storing.discard(key)
+            if os.path.exists(part):
+                os.remove(part)
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes and self.files:
+            key, size = self.files.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+
+    def stats(self):
+        plays = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / plays if plays else 0.0,
+            'stores': self.stores,
+            'evictions': self.evictions,
+            'entries': len(self.files),
+            'bytes': self.total_bytes,
+        }
+
+audio_cache = AudioCache(AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_MB * 1048576, AUDIO_CACHE_MIN_PLAYS)
+
+# How many upcoming queue entries get their stream URL resolved, all at once, while the current track plays
+PREFETCH_AHEAD = max(0, int(os.getenv('PREFETCH_AHEAD', '2')))
+# Failed playlist tracks are reported once this many have piled up, and when the playlist is done
+PLAYLIST_FAILURE_BATCH = 10
+
+# Queue entries only carry metadata; stream URLs are resolved right before playback.
+# playlist is the PlaylistLoad that queued the track, which counts its resolved and failed tracks
+Track = namedtuple('Track', ['source', 'title', 'provider', 'spotify', 'playlist'], defaults=(None, None))
+
+def encode_track(track):
+    return [track.source, track.title, track.provider, list(track.spotify) if track.spotify else None]
+
+def decode_track(data):
+    source, title, provider, spotify = data
+    return Track(source, title, provider, SpotifyTrack(*spotify) if spotify else None)
+
+class TrackQueue:
+    # A list with a moving head: popleft stays O(1) amortised while pages and positions are plain list indexing
+    __slots__ = ('items', 'head', 'journal')
+
+    def __init__(self):
+        self.items = []
+        self.head = 0
+        self.journal = None
+
+    def __len__(self):
+        return len(self.items) - self.head
+
+    def __iter__(self):
+        return islice(self.items, self.head, None)
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError('queue index out of range')
+        return self.items[self.head + index]
+
+    def append(self, track):
+        self.items.append(track)
+        if self.journal:
+            self.journal.write('A', [encode_track(track)])
+
+    def extend(self, tracks):
+        start = len(self.items)
+        self.items.extend(tracks)
+        if self.journal:
+            self.journal.write('A', [encode_track(track) for track in self.items[start:]])
+
+    def appendleft(self, track):
+        if self.head:
+            self.head -= 1
+            self.items[self.head] = track
+        else:
+            self.items.insert(0, track)
+
+    def popleft(self):
+        track = self[0]
+        self.items[self.head] = None
+        self.head += 1
+        self.compact()
+        if self.journal:
+            self.journal.write('D')
+        return track
+
+    def slice(self, start, stop):
+        return self.items[self.head + max(0, start):self.head + max(0, stop)]
+
+    def remove(self, index):
+        track = self[index]
+        del self.items[self.head + index]
+        if self.journal:
+            self.journal.write('R', index)
+        return track
+
+    def skip(self, count):
+        # Drops the first count tracks so the next one starts playing
+        count = min(count, len(self))
+        self.head += count
+        self.compact()
+        if self.journal:
+            self.journal.write('K', count)
+
+    def clear(self):
+        self.items = []
+        self.head = 0
+        if self.journal:
+            self.journal.write('C')
+
+    def compact(self):
+        if self.head > 64 and self.head * 2 > len(self.items):
+            del self.items[:self.head]
+            self.head = 0
+
 # Queue and state for each server
-queues = {}
-last_button_press = {}
-current_track = {}
-added_by = {}
-current_track_url = {}
-control_messages = {}
-update_tasks = {}
-bot_owner = {}
-voice_check_tasks = {}
+class GuildSession:
+    __slots__ = (
+        'guild_id', 'queue', 'current_track', 'added_by', 'owner_id', 'volume', 'lock', 'human_count',
+        'control_message', 'control_avatar', 'control_rendered', 'control_edited_at', 'prefetch_task', 'playlist_load',
+        'prebuffer', 'prebuffer_task', 'prebuffer_timer', 'current_source', 'play_requested_at',
+        'journal', 'playing', 'resume_at',
+    )
+
+    def __init__(self, guild_id, owner_id):
+        self.guild_id = guild_id
+        self.queue = TrackQueue()
+        self.current_track = None
+        self.added_by = None
+        self.owner_id = owner_id
+        self.volume = 1.0
+        self.lock = asyncio.Lock()
+        self.human_count = 0
+        self.control_message = None
+        self.control_avatar = None
+        self.control_rendered = None
+        self.control_edited_at = 0.0
+        self.prefetch_task = None
+        self.playlist_load = None
+        self.prebuffer = None
+        self.prebuffer_task = None
+        self.prebuffer_timer = None
+        self.current_source = None
+        self.play_requested_at = None
+        self.journal = None
+        self.playing = None
+        self.resume_at = 0.0
+
+    def close(self):
+        if self.prefetch_task:
+            self.prefetch_task.cancel()
+        discard_prebuffer(self)
+        if self.journal:
+            self.journal.discard()
+            self.journal = self.queue.journal = None
+        self.queue.clear()
+        self.current_source = None
+
+    def memory_usage(self):
+        size = sys.getsizeof(self) + sys.getsizeof(self.queue) + sys.getsizeof(self.queue.items)
+        for track in self.queue:
+            size += sys.getsizeof(track) + sum(sys.getsizeof(field) for field in track[:4])
+        return size
+
+class Cooldowns:
+    # Entries are kept in press order, so expired ones are always at the front and pruned in O(1) each
+    def __init__(self, period, max_entries=10000):
+        self.period = period
+        self.max_entries = max_entries
+        self.last = OrderedDict()
+
+    def prune(self, now):
+        while self.last:
+            key, pressed_at = next(iter(self.last.items()))
+            if now - pressed_at < self.period and len(self.last) <= self.max_entries:
+                break
+            self.last.popitem(last=False)
+
+    def ready(self, key):
+        self.prune(time.monotonic())
+        return key not in self.last
+
+    def touch(self, key):
+        self.last[key] = time.monotonic()
+        self.last.move_to_end(key)
+
+sessions = {}
+button_cooldowns = Cooldowns(1.0)
+stream_cpu_totals = {}
+MEMORY_REPORT_INTERVAL = 1800
+
+def read_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+def memory_report():
+    return {
+        'rss': read_rss(),
+        'sessions': {guild_id: session.memory_usage() for guild_id, session in sessions.items()},
+        'cooldowns': len(button_cooldowns.last),
+    }
+
+async def memory_report_loop():
+    while True:
+        await asyncio.sleep(MEMORY_REPORT_INTERVAL)
+        report = memory_report()
+        session_bytes = sum(report['sessions'].values())
+        largest = max(report['sessions'].items(), key=lambda item: item[1], default=(None, 0))
+        rss = f"{report['rss'] / 1048576:.1f} MB" if report['rss'] else "unknown"
+        logging.info(
+            f"Memory: RSS {rss}, {len(report['sessions'])} sessions using {session_bytes / 1024:.1f} KB "
+            f"(largest: guild {largest[0]}, {largest[1] / 1024:.1f} KB), {report['cooldowns']} cooldown entries"
+        )
+
+memory_report_task = None
+
+# Crash-safe queues: each session appends its queue changes and playback position to a journal file,
+# which is replayed on startup. Disabled when QUEUE_JOURNAL_DIR is empty
+QUEUE_JOURNAL_DIR = os.getenv('QUEUE_JOURNAL_DIR', 'queue_journal')
+JOURNAL_COMPACT_RECORDS = 1000
+JOURNAL_CHECKPOINT_INTERVAL = 15
+JOURNAL_RESTORE_CONCURRENCY = 5
+
+class QueueJournal:
+    # One JSON array per line: S session, P now playing, T position, A added, D popped, K skipped, R removed, C cleared
+    def __init__(self, session, voice_channel_id, text_channel_id):
+        self.session = session
+        self.voice_channel_id = voice_channel_id
+        self.text_channel_id = text_channel_id
+        self.path = os.path.join(QUEUE_JOURNAL_DIR, f"{session.guild_id}.jsonl")
+        self.started = False
+        self.records = 0
+        self.position = None
+
+    def write(self, *record):
+        if not self.started:
+            # The first change writes a full snapshot, which already includes it
+            self.compact()
+            return
+        try:
+            # Opened per record so idle guilds hold no file descriptor; closing hands the line to the OS,
+            # so only a crash of the whole machine can lose the tail
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, separators=(',', ':'), ensure_ascii=False) + '\n')
+            self.records += 1
+        except OSError as e:
+            logging.error(f"Queue journal write error for guild {self.session.guild_id}: {e}")
+
+    def write_session(self):
+        session = self.session
+        self.write('S', session.owner_id, self.voice_channel_id, self.text_channel_id, session.volume, session.resume_at)
+
+    def write_playing(self, track, position):
+        self.position = position
+        self.write('P', encode_track(track) if track else None, position)
+
+    def checkpoint(self):
+        source = self.session.current_source
+        if source and not source.closed and self.session.playing:
+            position = round(source.position, 1)
+            if position != self.position:
+                self.position = position
+                self.write('T', position)
+        if self.records >= JOURNAL_COMPACT_RECORDS:
+            self.compact()
+
+    def snapshot(self):
+        session = self.session
+        source = session.current_source
+        # resume_at is only set on a restored session whose interrupted track has not been started again yet
+        yield ('S', session.owner_id, self.voice_channel_id, self.text_channel_id, session.volume, session.resume_at)
+        if session.playing:
+            position = round(source.position, 1) if source and not source.closed else self.position or 0.0
+            yield ('P', encode_track(session.playing), position)
+        if session.queue:
+            yield ('A', [encode_track(track) for track in session.queue])
+
+    def compact(self):
+        # Rewrites the journal as a snapshot of the current state; os.replace keeps the old one valid until the swap
+        temp_path = self.path + '.tmp'
+        try:
+            os.makedirs(QUEUE_JOURNAL_DIR, exist_ok=True)
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                for record in self.snapshot():
+                    f.write(json.dumps(record, separators=(',', ':'), ensure_ascii=False) + '\n')
+            os.replace(temp_path, self.path)
+            self.started = True
+            self.records = 0
+        except OSError as e:
+            logging.error(f"Queue journal compaction error for guild {self.session.guild_id}: {e}")
+
+    def discard(self):
+        self.started = False
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.error(f"Error removing queue journal for guild {self.session.guild_id}: {e}")
+
+def attach_journal(session, voice_channel_id, text_channel_id):
+    if QUEUE_JOURNAL_DIR:
+        session.journal = session.queue.journal = QueueJournal(session, voice_channel_id, text_channel_id)
+    return session.journal
+
+def replay_journal(guild_id, path):
+    # Returns the rebuilt session with the interrupted track back at the head of its queue, or None
+    session = None
+    voice_channel_id = text_channel_id = None
+    playing = None
+    position = resume_at = 0.0
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                kind = record[0]
+                if kind == 'S':
+                    owner_id, voice_channel_id, text_channel_id, volume = record[1:5]
+                    resume_at = record[5] if len(record) > 5 else 0.0
+                    if session is None:
+                        session = GuildSession(guild_id, owner_id)
+                    session.owner_id = owner_id
+                    session.volume = volume
+                elif kind == 'P':
+                    playing = decode_track(record[1]) if record[1] else None
+                    position = record[2]
+                    resume_at = 0.0
+                elif kind == 'T':
+                    position = record[1]
+                elif kind == 'A':
+                    session.queue.extend(decode_track(track) for track in record[1])
+                elif kind == 'D':
+                    session.queue.popleft()
+                elif kind == 'K':
+                    session.queue.skip(record[1])
+                elif kind == 'R':
+                    session.queue.remove(record[1])
+                elif kind == 'C':
+                    session.queue.clear()
+            except (ValueError, TypeError, IndexError, AttributeError):
+                # A crash in the middle of a write leaves a truncated last line; everything before it is kept
+                logging.warning(f"Queue journal for guild {guild_id} is damaged after {session and len(session.queue)} tracks, ignoring the rest")
+                break
+    if session is None:
+        return None, None, None
+    if playing:
+        session.queue.appendleft(playing)
+        session.resume_at = position
+    else:
+        session.resume_at = resume_at
+    return session, voice_channel_id, text_channel_id
+
+async def journal_checkpoint_loop():
+    while True:
+        await asyncio.sleep(JOURNAL_CHECKPOINT_INTERVAL)
+        for session in list(sessions.values()):
+            if session.journal:
+                session.journal.checkpoint()
+
+journal_task = None
 
 # Переменная для отслеживания, сколько серверов сейчас проигрывают музыку
 active_playback_guilds = set()
 
+def presence_count():
+    return len(active_playback_guilds)
+
+# Shared store for the workers started by launcher.py: each one publishes its playback count and metrics,
+# and presence shows the total. Disabled when SHARED_STATE_DB is empty
+SHARED_STATE_DB = os.getenv('SHARED_STATE_DB', '')
+SHARED_STATE_INTERVAL = 30
+
+def collect_metrics():
+    return {
+        'sessions': len(sessions),
+        'playing': len(active_playback_guilds),
+        'extraction': extraction_scheduler.stats(),
+        'single_flight': extraction_flights.stats(),
+        'resolution_cache': resolution_cache.stats(),
+        'audio_cache': audio_cache.stats(),
+        'spotify_matches': spotify_matches.stats(),
+        'control_messages': control_scheduler.stats(),
+        'loop_lag': loop_lag_monitor.stats(),
+    }
+
+class SharedState:
+    def __init__(self, path, worker_id):
+        self.path = path
+        self.worker_id = worker_id
+        self.db = None
+        self.remote_count = 0
+        self.task = None
+
+    def connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, timeout=5)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS workers (worker_id TEXT PRIMARY KEY, playing INTEGER, metrics TEXT, updated_at REAL)")
+            self.db.commit()
+        return self.db
+
+    def count(self):
+        return len(active_playback_guilds) + self.remote_count
+
+    def sync(self):
+        db = self.connect()
+        now = time.time()
+        db.execute(
+            "INSERT OR REPLACE INTO workers VALUES (?, ?, ?, ?)",
+            (self.worker_id, len(active_playback_guilds), json.dumps(collect_metrics()), now),
+        )
+        db.commit()
+        # Workers that stopped reporting are left out of the total
+        row = db.execute(
+            "SELECT COALESCE(SUM(playing), 0) FROM workers WHERE worker_id != ? AND updated_at > ?",
+            (self.worker_id, now - SHARED_STATE_INTERVAL * 3),
+        ).fetchone()
+        self.remote_count = row[0]
+
+    def metrics(self):
+        rows = self.connect().execute(
+            "SELECT worker_id, metrics FROM workers WHERE updated_at > ?", (time.time() - SHARED_STATE_INTERVAL * 3,)
+        ).fetchall()
+        return {worker_id: json.loads(snapshot) for worker_id, snapshot in rows}
+
+    async def run(self):
+        while True:
+            try:
+                self.sync()
+                presence_manager.changed()
+            except sqlite3.Error as e:
+                logging.error(f"Shared state sync error: {e}")
+            await asyncio.sleep(SHARED_STATE_INTERVAL)
+
+shared_state = SharedState(SHARED_STATE_DB, WORKER_ID) if SHARED_STATE_DB else None
+
+def flatten_stats(stats, prefix=''):
+    for name, value in stats.items():
+        if isinstance(value, dict):
+            yield from flatten_stats(value, f"{prefix}{name}_")
+        elif isinstance(value, list):
+            yield from flatten_stats({str(i): item for i, item in enumerate(value)}, f"{prefix}{name}_")
+        elif isinstance(value, (int, float)):
+            yield f"{prefix}{name}", value
+
+def worker_stats():
+    # Every worker's latest collect_metrics() snapshot from the shared store, with this worker's taken live
+    snapshots = shared_state.metrics() if shared_state else {}
+    snapshots[WORKER_ID] = collect_metrics()
+    return {(worker_id, stat): value for worker_id, snapshot in snapshots.items() for stat, value in flatten_stats(snapshot)}
+
+metrics.gauge('musicbot_worker_stat', 'Internal counters of each worker (caches, scheduler, control messages)', ('worker', 'stat'), worker_stats)
+
+class PresenceManager:
+    def __init__(self, count_source):
+        self.count_source = count_source
+        self.published = None
+        self.last_publish = 0.0
+        self.task = None
+
+    def changed(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(max(PRESENCE_DEBOUNCE, self.last_publish + PRESENCE_MIN_INTERVAL - time.monotonic()))
+            if self.count_source() == self.published:
+                return
+            try:
+                await self.publish()
+            except Exception as e:
+                logging.error(f"Error updating presence: {e}")
+                self.last_publish = time.monotonic()
+
+    async def publish(self, force=False):
+        count = self.count_source()
+        if count == self.published and not force:
+            return
+        # Applies to every shard this client runs, so the count is the combined one
+        await client.change_presence(activity=discord.Activity(type=discord.ActivityType.playing, name=f"Playing music on {count} servers"))
+        self.published = count
+        self.last_publish = time.monotonic()
+
+presence_manager = PresenceManager(shared_state.count if shared_state else presence_count)
+
+# Hash of the last synced command schema; delete the file to force a sync
+COMMAND_HASH_FILE = os.getenv('COMMAND_HASH_FILE', 'command_hash.txt')
+commands_checked = False
+
+def command_schema_hash():
+    schema = [command.to_dict(tree) for command in tree.get_commands()]
+    return hashlib.sha256(json.dumps(schema, sort_keys=True).encode()).hexdigest()
+
+async def sync_commands():
+    # tree.sync() is slow and rate limited, so it only runs when the commands changed since the last sync
+    schema_hash = f"{client.application_id}:{command_schema_hash()}"
+    try:
+        with open(COMMAND_HASH_FILE) as f:
+            if f.read().strip() == schema_hash:
+                return False
+    except OSError:
+        pass
+    await tree.sync()
+    try:
+        with open(COMMAND_HASH_FILE, 'w') as f:
+            f.write(schema_hash)
+    except OSError as e:
+        logging.error(f"Could not save the command schema hash: {e}")
+    return True
+
 @client.event
 async def on_ready():
-    await tree.sync()
-    await client.change_presence(activity=discord.Activity(type=discord.ActivityType.playing, name=f"Playing music on {len(active_playback_guilds)} servers"))
-    logging.info(f'Bot {client.user} has successfully started and connected! Commands are synchronized.')
+    global loop_lag_task, memory_report_task, metrics_runner, commands_checked, journal_task
+    if loop_lag_task is None:
+        loop_lag_task = asyncio.create_task(loop_lag_monitor.run())
+        # Scanned on startup rather than at import, so importing main.py has no effect on the cache directory
+        audio_cache.load()
+    if METRICS_PORT and metrics_runner is None:
+        metrics_runner = await metrics.serve(METRICS_HOST, METRICS_PORT + int(WORKER_ID), METRICS_PROFILING)
+    if memory_report_task is None:
+        memory_report_task = asyncio.create_task(memory_report_loop())
+    if shared_state and shared_state.task is None:
+        shared_state.task = asyncio.create_task(shared_state.run())
+    # Application commands are global, so only the worker running shard 0 syncs them, and only once per process
+    if not commands_checked and (SHARD_IDS is None or 0 in SHARD_IDS):
+        if await sync_commands():
+            logging.info("Command schema changed, commands are synchronized.")
+        else:
+            logging.info("Command schema unchanged, skipping sync.")
+        commands_checked = True
+    if QUEUE_JOURNAL_DIR and journal_task is None:
+        journal_task = asyncio.create_task(journal_checkpoint_loop())
+        asyncio.create_task(restore_sessions())
+    await presence_manager.publish(force=True)
+    logging.info(f'Bot {client.user} has successfully started and connected!')
 
-async def get_youtube_url(query):
-    loop = asyncio.get_event_loop()
-    with yt_dlp.YoutubeDL(YDL_OPTIONS_FULL) as ydl:
-        try:
+def to_resolved_track(info):
+    if 'entries' in info and info['entries']:
+        info = info['entries'][0]
+    if not info or 'url' not in info:
+        return None
+    return ResolvedTrack(
+        info['url'],
+        info.get('title', 'Unknown Title'),
+        info.get('duration'),
+        info.get('id'),
+        info.get('webpage_url'),
+        get_stream_expiry(info['url']),
+        info.get('acodec'),
+    )
+
+async def resolve_youtube(query, guild_id=None, priority=PRIORITY_INTERACTIVE):
+    key = f"youtube:{normalize_source(query)}"
+    cached = resolution_cache.get(key)
+    if cached and cached.expires_at - time.time() > RESOLUTION_REFRESH_MARGIN:
+        return cached, None
+
+    try:
+        if cached and cached.video_id:
+            # Near expiry: a direct video lookup is much cheaper than repeating the search
+            logging.info(f"Refreshing stream URL for video {cached.video_id}")
+            target = f"https://www.youtube.com/watch?v={cached.video_id}"
+            resolution_cache.refreshes += 1
+        else:
             logging.info(f"Searching YouTube for query: {query}")
             logging.info(f"Using YouTube cookies from file: {YDL_OPTIONS_FULL.get('cookiefile', 'Not specified')}")
-            await asyncio.sleep(1)
-            result = await loop.run_in_executor(None, lambda: ydl.extract_info(query, download=False))
-            if 'entries' in result and result['entries']:
-                logging.info(f"Found YouTube result: {result['entries'][0]['title']}")
-                return result['entries'][0]['url'], result['entries'][0]['title']
-            elif 'url' in result:
-                logging.info(f"Found direct YouTube URL: {result['title']}")
-                return result['url'], result['title']
-            else:
-                logging.warning(f"No results found for query: {query}")
-                return None, None
-        except Exception as e:
-            logging.error(f"YouTube search error for query '{query}': {e}")
-            if "Sign in to confirm you’re not a bot" in str(e):
-                return None, "Authentication required: Please update your YouTube cookies in `youtube_cookies.txt`. See README.md for instructions."
-            return None, str(e)
-
-async def get_youtube_playlist_urls(playlist_url):
-    loop = asyncio.get_event_loop()
-    with yt_dlp.YoutubeDL(YDL_OPTIONS) as ydl:
-        try:
-            logging.info(f"Using YouTube cookies from file for playlist: {YDL_OPTIONS.get('cookiefile', 'Not specified')}")
-            result = await loop.run_in_executor(None, lambda: ydl.extract_info(playlist_url, download=False))
-            if 'entries' in result:
-                return [(entry['url'], entry.get('title', 'Unknown Title')) for entry in result['entries']]
-            return []
-        except Exception as e:
-            logging.error(f"Error extracting YouTube playlist URLs: {e}")
-            return []
+            target = query
+        result = await run_extraction('youtube_full', target, guild_id, priority)
+        resolved = to_resolved_track(result)
+        if not resolved:
+            logging.warning(f"No results found for query: {query}")
+            return None, None
+        logging.info(f"Found YouTube result: {resolved.title}")
+        resolution_cache.put(key, resolved)
+        return resolved, None
+    except Exception as e:
+        logging.error(f"YouTube search error for query '{query}': {e}")
+        if cached:
+            return cached, None
+        if "Sign in to confirm you’re not a bot" in str(e):
+            return None, "Authentication required: Please update your YouTube cookies in `youtube_cookies.txt`. See README.md for instructions."
+        return None, str(e)
+
+async def refresh_resolved(resolved, guild_id=None, force=False):
+    # Re-extracts a known track directly by its page instead of repeating the original search
+    if audio_cache.lookup(resolved) or (not force and resolved.expires_at - time.time() > STREAM_URL_MIN_TTL):
+        return resolved
+    page_url = resolved.page_url or ''
+    if 'soundcloud.com' in page_url:
+        options_name, target = 'soundcloud_full', page_url
+    elif resolved.video_id:
+        options_name, target = 'youtube_full', f"https://www.youtube.com/watch?v={resolved.video_id}"
+    else:
+        return None if force else resolved
+    logging.info(f"Refreshing stream URL for {resolved.title}")
+    try:
+        result = await run_extraction(options_name, target, guild_id)
+        return to_resolved_track(result) or (None if force else resolved)
+    except Exception as e:
+        logging.error(f"Stream refresh error for {resolved.title}: {e}")
+        return None if force else resolved
+
+async def get_youtube_url(query, guild_id=None):
+    resolved, error = await resolve_youtube(query, guild_id)
+    if resolved:
+        return resolved.stream_url, resolved.title
+    return None, error
 
-async def get_soundcloud_url(url):
-    loop = asyncio.get_event_loop()
-    with yt_dlp.YoutubeDL(YDL_OPTIONS_SOUNDCLOUD_FULL) as ydl:
+async def iter_flat_playlist_pages(provider, playlist_url, guild_id=None):
+    # Windows until a short page; the first one is awaited by the user, the rest only fill the queue.
+    # YouTube can only reach an item by walking the listing from the start, so each window repeats that walk;
+    # doubling the window size keeps the total work linear in the playlist length
+    start = 1
+    size = PLAYLIST_PAGE_SIZE
+    priority = PRIORITY_INTERACTIVE
+    while True:
+        playlist_items = f'{start}-{start + size - 1}'
         try:
-            result = await loop.run_in_executor(None, lambda: ydl.extract_info(url, download=False))
-            if 'entries' in result and result['entries']:
-                return result['entries'][0]['url'], result['entries'][0]['title']
-            elif 'url' in result:
-                return result['url'], result['title']
+            result = await run_extraction(provider, playlist_url, guild_id, priority, playlist_items)
         except Exception as e:
-            logging.error(f"SoundCloud search error: {e}")
+            logging.error(f"Error extracting {provider} playlist URLs ({playlist_items}): {e}")
+            return
+        entries = result.get('entries') or []
+        if entries:
+            yield [Track(entry['url'], entry.get('title', 'Unknown Title'), provider) for entry in entries]
+        if len(entries) < size:
+            return
+        start += size
+        size *= 2
+        priority = PRIORITY_BACKGROUND
+
+async def iter_youtube_playlist_pages(playlist_url, guild_id=None):
+    logging.info(f"Using YouTube cookies from file for playlist: {YDL_OPTIONS.get('cookiefile', 'Not specified')}")
+    async for page in iter_flat_playlist_pages('youtube', playlist_url, guild_id):
+        yield page
+
+async def resolve_soundcloud(url, guild_id=None, priority=PRIORITY_INTERACTIVE):
+    key = f"soundcloud:{normalize_source(url)}"
+    cached = resolution_cache.get(key)
+    if cached and cached.expires_at - time.time() > RESOLUTION_REFRESH_MARGIN:
+        return cached
+
+    target = cached.page_url if cached and cached.page_url else url
+    if cached:
+        resolution_cache.refreshes += 1
+    try:
+        result = await run_extraction('soundcloud_full', target, guild_id, priority)
+        resolved = to_resolved_track(result)
+        if resolved:
+            resolution_cache.put(key, resolved)
+            return resolved
+    except Exception as e:
+        logging.error(f"SoundCloud search error: {e}")
+    return cached
+
+async def get_soundcloud_url(url, guild_id=None):
+    resolved = await resolve_soundcloud(url, guild_id)
+    if resolved:
+        return resolved.stream_url, resolved.title
     return None, None
 
-async def get_soundcloud_playlist_urls(playlist_url):
-    loop = asyncio.get_event_loop()
-    with yt_dlp.YoutubeDL(YDL_OPTIONS_SOUNDCLOUD) as ydl:
-        try:
-            result = await loop.run_in_executor(None, lambda: ydl.extract_info(playlist_url, download=False))
-            if 'entries' in result:
-                return [(entry['url'], entry.get('title', 'Unknown Title')) for entry in result['entries']]
-            return []
-        except Exception as e:
-            logging.error(f"Error extracting SoundCloud playlist URLs: {e}")
-            return []
+async def iter_soundcloud_playlist_pages(playlist_url, guild_id=None):
+    async for page in iter_flat_playlist_pages('soundcloud', playlist_url, guild_id):
+        yield page
+
+SpotifyTrack = namedtuple('SpotifyTrack', ['id', 'artist', 'name', 'isrc', 'duration_ms'])
+
+class LRUCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+spotify_track_cache = LRUCache(SPOTIFY_TRACK_CACHE_SIZE)
+spotify_playlist_cache = LRUCache(SPOTIFY_PLAYLIST_CACHE_SIZE)
+
+def get_spotify_id(kind, url):
+    match = re.search(rf'{kind}[/:]([A-Za-z0-9]+)', url)
+    return match.group(1) if match else url
+
+def spotify_query(track):
+    return f"{track.artist} - {track.name}"
+
+# Words in a "(...)" or " - ..." suffix that make a different recording and stay in the match key
+MATCH_QUALIFIERS = {'live', 'remix', 'mix', 'acoustic', 'instrumental', 'demo', 'unplugged', 'karaoke', 'edit', 'extended', 'slowed', 'sped', 'cover'}
+# A stored match is only reused when its video is within this many seconds of the Spotify track
+MATCH_DURATION_TOLERANCE = 5
+
+def match_key(artist, name):
+    # "Song (feat. X) - Remastered 2011" and "song" by the same artist share a key; "Song - Live" does not
+    normalize = lambda text: ' '.join(re.sub(r'[^\w\s]', ' ', text.casefold()).split())
+    suffixes = re.findall(r'[\(\[]([^\)\]]*)[\)\]]', name) + re.findall(r'\s+-\s+(.*)$', name)
+    name = re.sub(r'\s*[\(\[][^\)\]]*[\)\]]', '', name)
+    name = re.sub(r'\s+-\s+.*$', '', name)
+    qualifiers = sorted({word for suffix in suffixes for word in normalize(suffix).split() if word in MATCH_QUALIFIERS})
+    key = f"{normalize(artist)}|{normalize(name)}"
+    return f"{key}|{' '.join(qualifiers)}" if qualifiers else key
+
+def durations_match(track, duration):
+    return not duration or not track.duration_ms or abs(duration - track.duration_ms / 1000) <= MATCH_DURATION_TOLERANCE
+
+class SpotifyMatchIndex:
+    # Persistent Spotify track -> YouTube video id mapping, so known tracks skip the ytsearch step.
+    # The SQLite file is self-contained and can be copied between nodes
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+
+    def connect(self):
+        # Opened on first use rather than at startup
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, timeout=5)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS matches (spotify_id TEXT PRIMARY KEY, isrc TEXT, match_key TEXT, video_id TEXT NOT NULL, duration REAL)")
+            if 'duration' not in [row[1] for row in self.db.execute("PRAGMA table_info(matches)")]:
+                self.db.execute("ALTER TABLE matches ADD COLUMN duration REAL")
+            self.db.execute("CREATE INDEX IF NOT EXISTS matches_isrc ON matches (isrc)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS matches_key ON matches (match_key)")
+            self.db.commit()
+        return self.db
+
+    def lookup(self, track):
+        # Returns (video_id, exact), where exact means the match was recorded for this very Spotify track
+        db = self.connect()
+        for column, value in (('spotify_id', track.id), ('isrc', track.isrc), ('match_key', match_key(track.artist, track.name))):
+            if not value:
+                continue
+            for video_id, duration in db.execute(f"SELECT video_id, duration FROM matches WHERE {column} = ? LIMIT 5", (value,)):
+                if durations_match(track, duration):
+                    self.hits += 1
+                    return video_id, column == 'spotify_id'
+                self.rejected += 1
+        self.misses += 1
+        return None, False
 
-def get_spotify_track_info(track_url):
+    def record(self, track, video_id, duration=None):
+        if not track.id:
+            return
+        self.connect().execute(
+            "INSERT OR REPLACE INTO matches (spotify_id, isrc, match_key, video_id, duration) VALUES (?, ?, ?, ?, ?)",
+            (track.id, track.isrc, match_key(track.artist, track.name), video_id, duration),
+        )
+        self.db.commit()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'rejected': self.rejected, 'hit_rate': self.hits / lookups if lookups else 0.0}
+
+spotify_matches = SpotifyMatchIndex(SPOTIFY_MATCH_DB)
+
+async def resolve_spotify_track(track, guild_id=None, priority=PRIORITY_INTERACTIVE):
+    video_id, exact = spotify_matches.lookup(track)
+    if video_id:
+        resolved, _ = await resolve_youtube(f"https://www.youtube.com/watch?v={video_id}", guild_id, priority)
+        if resolved:
+            if not exact:
+                # An ISRC or title match: remember it under this track's id so the next lookup is exact
+                spotify_matches.record(track, video_id, resolved.duration)
+            return resolved, None
+    resolved, error = await resolve_youtube(spotify_query(track), guild_id, priority)
+    if resolved and resolved.video_id and resolved.video_id != video_id:
+        spotify_matches.record(track, resolved.video_id, resolved.duration)
+    return resolved, error
+
+def to_spotify_track(data):
+    artists = data.get('artists') or [{'name': ''}]
+    track = SpotifyTrack(data.get('id'), artists[0]['name'], data['name'], (data.get('external_ids') or {}).get('isrc'), data.get('duration_ms'))
+    if track.id:
+        spotify_track_cache.put(track.id, track)
+    return track
+
+async def spotify_call(method, *args, **kwargs):
+    # spotipy is synchronous, so every request runs on its own small thread pool instead of the event loop
+    loop = asyncio.get_running_loop()
+    with EXTRACTION_SECONDS.time(provider='spotify', function=method):
+        return await loop.run_in_executor(spotify_executor, lambda: getattr(get_spotify(), method)(*args, **kwargs))
+
+async def get_spotify_track_info(track_url):
+    track_id = get_spotify_id('track', track_url)
+    cached = spotify_track_cache.get(track_id)
+    if cached:
+        return cached
     try:
-        track = sp.track(track_url)
-        return f"{track['artists'][0]['name']} - {track['name']}"
-    except spotipy.exceptions.SpotifyException as e:
+        return to_spotify_track(await spotify_call('track', track_id))
+    except Exception as e:
         logging.error(f"Spotify API error in get_spotify_track_info: {e}")
         raise
 
-def get_spotify_playlist_tracks(playlist_url):
+async def get_spotify_playlist_page(playlist_id, offset):
+    results = await spotify_call('playlist_items', playlist_id, limit=SPOTIFY_PAGE_SIZE, offset=offset, fields=f'items(track({SPOTIFY_TRACK_FIELDS}))', additional_types=('track',))
+    return [to_spotify_track(item['track']) for item in results['items'] if item.get('track') and item['track'].get('name')]
+
+def to_queue_tracks(spotify_tracks):
+    return [Track(spotify_query(track), spotify_query(track), 'youtube', track) for track in spotify_tracks]
+
+async def iter_spotify_playlist_pages(playlist_url, load=None):
+    playlist_id = get_spotify_id('playlist', playlist_url)
+    pages = []
     try:
-        results = sp.playlist_tracks(playlist_url, limit=100)
-        tracks = [f"{item['track']['artists'][0]['name']} - {item['track']['name']}" for item in results['items']]
-        while results['next']:
-            results = sp.next(results)
-            tracks.extend([f"{item['track']['artists'][0]['name']} - {item['track']['name']}" for item in results['items']])
-        return tracks
-    except spotipy.exceptions.SpotifyException as e:
-        logging.error(f"Spotify API error in get_spotify_playlist_tracks: {e}")
+        # The snapshot check comes first, so an unchanged playlist costs exactly one request
+        playlist = await spotify_call('playlist', playlist_id, fields='snapshot_id,tracks.total')
+        total = playlist['tracks']['total']
+        if load:
+            load.total = total
+        cached = spotify_playlist_cache.get(playlist_id)
+        if cached and cached[0] == playlist['snapshot_id']:
+            logging.info(f"Spotify playlist {playlist_id} is unchanged, using cached tracks.")
+            yield to_queue_tracks(cached[1])
+            return
+        pages = [asyncio.create_task(get_spotify_playlist_page(playlist_id, offset)) for offset in range(0, total, SPOTIFY_PAGE_SIZE)]
+        tracks = []
+        for page in pages:
+            page_tracks = await page
+            tracks.extend(page_tracks)
+            yield to_queue_tracks(page_tracks)
+        spotify_playlist_cache.put(playlist_id, (playlist['snapshot_id'], tracks))
+    except Exception as e:
+        logging.error(f"Spotify API error in iter_spotify_playlist_pages: {e}")
         raise
+    finally:
+        for page in pages:
+            page.cancel()
+
+class PlaylistLoad:
+    # Tracks are resolved when they come up, so resolved and failed grow as the playlist plays
+    def __init__(self):
+        self.loaded = 0
+        self.total = None
+        self.resolved = 0
+        self.failed = 0
+        self.dropped = 0
+        self.done = False
+        self.failures = []
+        self.errors = set()
+
+    def adopt(self, page):
+        self.loaded += len(page)
+        return [track._replace(playlist=self) for track in page]
+
+    @property
+    def pending(self):
+        return self.loaded - self.resolved - self.failed - self.dropped
+
+    @property
+    def finished(self):
+        return self.done and self.pending <= 0
+
+    def __str__(self):
+        loaded = f"{self.loaded} tracks loaded" if self.total is None else f"{self.loaded}/{self.total} tracks loaded"
+        return f"{loaded}, {self.resolved} resolved, {self.failed} failed, {self.pending} pending"
+
+def drop_tracks(tracks):
+    # Removed, skipped or cleared tracks no longer count as pending
+    for track in tracks:
+        if track.playlist:
+            track.playlist.dropped += 1
+
+async def ingest_playlist(interaction: discord.Interaction, pages, load):
+    guild_id = interaction.guild.id
+    session = sessions[guild_id]
+    first_page_size = load.loaded
+    try:
+        async for page in pages:
+            if sessions.get(guild_id) is not session:
+                logging.info(f"Session for guild {guild_id} was closed, stopping playlist loading.")
+                return
+            session.queue.extend(load.adopt(page))
+            control_scheduler.mark_dirty(guild_id)
+            # The queue may have run dry while waiting for this page
+            vc = discord.utils.get(client.voice_clients, guild=interaction.guild)
+            if vc and not vc.is_playing() and not vc.is_paused():
+                await play_next(interaction)
+        logging.info(f"Playlist loaded for guild {guild_id}: {load}")
+        if load.loaded > first_page_size:
+            await interaction.followup.send(f"Finished loading the playlist: {load}.", ephemeral=True)
+    except Exception as e:
+        logging.error(f"Error loading playlist pages: {e}")
+        await interaction.followup.send(f"Could not load the rest of the playlist: {e}", ephemeral=True)
+    finally:
+        await pages.aclose()
+        load.done = True
+        control_scheduler.mark_dirty(guild_id)
+        if load.finished:
+            await flush_playlist_failures(interaction, load)
 
-async def update_control_message(guild_id, user_avatar):
-    while guild_id in control_messages:
-        if guild_id not in control_messages:
+def render_control_embed(session):
+    embed = discord.Embed(title="Music Control", description=f"🎵 Now playing: **{session.current_track or 'Nothing is playing'}**", color=discord.Color.blue())
+    embed.set_thumbnail(url=session.control_avatar)
+    footer = f"In queue: {len(session.queue)} tracks | Added by: {session.added_by or 'Unknown'}"
+    if session.playlist_load and not session.playlist_load.finished:
+        footer += f" | Playlist: {session.playlist_load}"
+    embed.set_footer(text=footer)
+    return embed
+
+class ControlMessageScheduler:
+    def __init__(self):
+        self.dirty = OrderedDict()
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.edits = 0
+        self.skipped = 0
+        self.rate_limited = 0
+
+    def mark_dirty(self, guild_id):
+        session = sessions.get(guild_id)
+        if not session or not session.control_message:
             return
-        message = control_messages.get(guild_id)
-        if not message:
+        self.dirty[guild_id] = None
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        self.wakeup.set()
+
+    def sent(self, session, embed):
+        session.control_rendered = embed.to_dict()
+        session.control_edited_at = time.monotonic()
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            await asyncio.sleep(CONTROL_UPDATE_DELAY)
+            while self.dirty:
+                now = time.monotonic()
+                ready = []
+                for guild_id in list(self.dirty):
+                    session = sessions.get(guild_id)
+                    if not session or not session.control_message:
+                        del self.dirty[guild_id]
+                    elif now - session.control_edited_at >= CONTROL_MIN_INTERVAL:
+                        ready.append(session)
+                for session in ready[:CONTROL_EDITS_PER_SECOND]:
+                    del self.dirty[session.guild_id]
+                    await self.flush(session)
+                await asyncio.sleep(1)
+
+    async def flush(self, session):
+        embed = render_control_embed(session)
+        if embed.to_dict() == session.control_rendered:
+            self.skipped += 1
             return
-        embed = discord.Embed(title="Music Control", description=f"🎵 Now playing: **{current_track.get(guild_id, 'Nothing is playing')}**", color=discord.Color.blue())
-        embed.set_thumbnail(url=user_avatar)
-        embed.set_footer(text=f"In queue: {len(queues.get(guild_id, deque()))} tracks | Added by: {added_by.get(guild_id, 'Unknown')}")
         try:
-            await message.edit(embed=embed)
-        except Exception as e:
+            await session.control_message.edit(embed=embed)
+            self.edits += 1
+            self.sent(session, embed)
+        except discord.HTTPException as e:
+            if e.status == 429:
+                self.rate_limited += 1
+                session.control_edited_at = time.monotonic()
+                self.dirty[session.guild_id] = None
+                return
+            # Interaction followups can no longer be edited once their token expires
             logging.error(f"Error updating message: {e}")
-            break
-        await asyncio.sleep(30)
+            session.control_message = None
+
+    def stats(self):
+        return {'edits': self.edits, 'skipped': self.skipped, 'rate_limited': self.rate_limited, 'dirty': len(self.dirty)}
+
+control_scheduler = ControlMessageScheduler()
+
+async def resolve_queued_track(track, guild_id=None, priority=PRIORITY_INTERACTIVE):
+    if track.provider == 'soundcloud':
+        return await resolve_soundcloud(track.source, guild_id, priority), None
+    if track.spotify:
+        return await resolve_spotify_track(track.spotify, guild_id, priority)
+    return await resolve_youtube(track.source, guild_id, priority)
+
+async def prefetch_upcoming(session):
+    queue = session.queue
+    if not queue or not PREFETCH_AHEAD:
+        return
+    upcoming = queue.slice(0, PREFETCH_AHEAD)
+    # Resolving warms the resolution cache, so play_next finds these tracks ready
+    await asyncio.gather(*(resolve_queued_track(track, session.guild_id, PRIORITY_PREFETCH) for track in upcoming), return_exceptions=True)
+
+def schedule_prefetch(session):
+    if session.prefetch_task and not session.prefetch_task.done():
+        session.prefetch_task.cancel()
+    session.prefetch_task = asyncio.create_task(prefetch_upcoming(session))
+
+async def send_failure_summary(interaction: discord.Interaction, failures, errors, total=None):
+    summary = f"Could not play {len(failures)} tracks: " if total is None else f"Could not play {len(failures)} of {total} playlist tracks: "
+    summary += ", ".join(failures[:10])
+    if len(failures) > 10:
+        summary += f" and {len(failures) - 10} more"
+    for error in list(errors)[:3]:
+        summary += f"\n{error}"
+    await interaction.followup.send(summary[:2000], ephemeral=True)
+
+def settle_track(load, resolved, track, error):
+    if resolved:
+        load.resolved += 1
+        return
+    load.failed += 1
+    load.failures.append(track.title)
+    if error:
+        load.errors.add(error)
+
+async def flush_playlist_failures(interaction: discord.Interaction, load, force=True):
+    # Playlist failures are reported in batches rather than once per skipped track
+    if not load.failures or not (force or len(load.failures) >= PLAYLIST_FAILURE_BATCH):
+        return
+    failures, errors = load.failures, load.errors
+    load.failures, load.errors = [], set()
+    try:
+        await send_failure_summary(interaction, failures, errors, load.total or load.loaded)
+    except discord.HTTPException as e:
+        logging.error(f"Could not send the playlist failure summary: {e}")
+
+# How often the voice thread samples FFmpeg's CPU time, so a value survives if the process is reaped early
+FFMPEG_CPU_SAMPLE_FRAMES = 250
+
+def read_process_cpu(pid):
+    # utime + stime from /proc, in seconds; unavailable outside Linux
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+class TrackedSource(discord.AudioSource):
+    open_count = 0
+
+    def __init__(self, source, resolved, mode, volume, offset=0.0):
+        TrackedSource.open_count += 1
+        self.source = source
+        self.resolved = resolved
+        self.mode = mode
+        self._volume = volume
+        self.offset = offset
+        self.frames = 0
+        self.cpu_start = None
+        self.cpu_last = None
+        self.ffmpeg_cpu = None
+        self.replaced = None
+        self.closed = False
+        self.buffer = deque()
+        self.cached = False
+        self.stopped = False
+        self.recoveries = 0
+        self.requested_at = None
+
+    @property
+    def position(self):
+        return self.offset + self.frames * 0.02
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value):
+        self._volume = value
+        if self.mode == 'pcm':
+            self.source.volume = value
+
+    def read(self):
+        # Runs on the voice thread, which also does the Opus encoding, so its CPU time covers the whole in-process path
+        now = time.thread_time()
+        if self.cpu_start is None:
+            self.cpu_start = now
+            if self.requested_at is not None:
+                TIME_TO_FIRST_AUDIO.observe(time.perf_counter() - self.requested_at)
+            if self.replaced:
+                self.replaced.cleanup()
+                self.replaced = None
+        self.cpu_last = now
+        data = self.buffer.popleft() if self.buffer else self.source.read()
+        if data:
+            self.frames += 1
+            if self.frames % FFMPEG_CPU_SAMPLE_FRAMES == 0:
+                self.ffmpeg_cpu = self.read_ffmpeg_cpu() or self.ffmpeg_cpu
+        return data
+
+    def prefill(self, frames):
+        # Blocks until FFmpeg has opened the stream and produced the first frames; run it off the event loop
+        while len(self.buffer) < frames:
+            data = self.source.read()
+            if not data:
+                break
+            self.buffer.append(data)
+
+    def is_opus(self):
+        return self.source.is_opus()
+
+    def ffmpeg_source(self):
+        return self.source.original if isinstance(self.source, discord.PCMVolumeTransformer) else self.source
+
+    def process(self):
+        return getattr(self.ffmpeg_source(), '_process', None)
+
+    @property
+    def _current_error(self):
+        # AudioPlayer reads this from its source when the stream ends and passes it to after=
+        return getattr(self.ffmpeg_source(), '_current_error', None)
+
+    def read_ffmpeg_cpu(self):
+        # poll() is not used here: it would reap an FFmpeg that already exited, and with it the /proc entry
+        # that still holds its CPU times. returncode stays None until something reaps it, so the pid is still ours
+        process = self.process()
+        return read_process_cpu(process.pid) if process and process.returncode is None else None
+
+    def cleanup(self):
+        if self.closed:
+            return
+        self.closed = True
+        TrackedSource.open_count -= 1
+        if self.replaced:
+            self.replaced.cleanup()
+        ffmpeg_cpu = self.read_ffmpeg_cpu() or self.ffmpeg_cpu
+        self.source.cleanup()
+        played = self.frames * 0.02
+        python_cpu = (self.cpu_last - self.cpu_start) if self.cpu_start is not None else 0.0
+        totals = stream_cpu_totals.setdefault(self.mode, {'streams': 0, 'seconds': 0.0, 'ffmpeg_cpu': 0.0, 'python_cpu': 0.0})
+        totals['streams'] += 1
+        totals['seconds'] += played
+        totals['python_cpu'] += python_cpu
+        totals['ffmpeg_cpu'] += ffmpeg_cpu or 0.0
+        if played:
+            logging.info(
+                f"Stream stats ({self.mode}) for {self.resolved.title}: played {played:.0f} s, "
+                f"FFmpeg CPU {ffmpeg_cpu if ffmpeg_cpu is not None else float('nan'):.2f} s, voice thread CPU {python_cpu:.2f} s "
+                f"({((ffmpeg_cpu or 0.0) + python_cpu) / played * 100:.1f}% of one core)"
+            )
+
+def create_audio_source(resolved, volume, offset=0.0):
+    url = resolved.stream_url
+    before_options = FFMPEG_OPTIONS['before_options']
+    mode = PLAYBACK_MODE
+    cached_path = audio_cache.lookup(resolved)
+    if cached_path:
+        url = cached_path
+        before_options = ''
+        if volume == 1.0:
+            # Cached files are already Opus, so they are sent without re-encoding whatever the playback mode
+            mode = 'opus'
+    if offset:
+        before_options = f"-ss {offset:.2f} {before_options}"
+    if mode == 'opus':
+        if volume == 1.0 and (cached_path or resolved.acodec == 'opus'):
+            # The upstream stream is already Opus, so FFmpeg only remuxes it
+            source = discord.FFmpegOpusAudio(url, codec='copy', before_options=before_options, options=FFMPEG_OPTIONS['options'])
+        else:
+            source = discord.FFmpegOpusAudio(url, before_options=before_options, options=f"{FFMPEG_OPTIONS['options']} -af volume={volume:.2f}")
+    else:
+        source = discord.FFmpegPCMAudio(url, before_options=before_options, options=FFMPEG_OPTIONS['options'])
+        source = discord.PCMVolumeTransformer(source, volume=volume)
+    source = TrackedSource(source, resolved, mode, volume, offset)
+    source.cached = cached_path is not None
+    return source
+
+def replace_source(session, vc, source):
+    # Swapping the player's source keeps the after= callback from firing, so play_next is not triggered
+    was_paused = vc.is_paused()
+    source.replaced = vc.source
+    vc.source = source
+    if was_paused:
+        vc.pause()
+    session.current_source = source
+    schedule_prebuffer(session, source)
+
+async def seek_current(session, vc, position):
+    source = vc.source
+    resolved = await refresh_resolved(source.resolved, session.guild_id)
+    if vc.source is not source:
+        return
+    replace_source(session, vc, create_audio_source(resolved, source.volume, position))
+
+def start_source(interaction: discord.Interaction, session, vc, source):
+    vc.play(source, after=lambda e: asyncio.run_coroutine_threadsafe(track_finished(interaction, e), client.loop))
+    session.current_source = source
+    schedule_prebuffer(session, source)
+
+async def track_finished(interaction: discord.Interaction, error):
+    if client.is_closed():
+        # Shutting down: leave the queue and its journal as they are so the next start can resume them
+        return
+    session = sessions.get(interaction.guild.id)
+    source = session.current_source if session else None
+    if (
+        source and not source.stopped and source.resolved.duration
+        and source.position < source.resolved.duration - STREAM_END_TOLERANCE
+        and source.recoveries < STREAM_RECOVERY_ATTEMPTS
+        and await recover_stream(interaction, session, source, error)
+    ):
+        return
+    await play_next(interaction)
+
+async def recover_stream(interaction: discord.Interaction, session, source, error):
+    vc = discord.utils.get(client.voice_clients, guild=interaction.guild)
+    async with session.lock:
+        if not vc or sessions.get(session.guild_id) is not session or session.current_source is not source:
+            return True
+        if vc.is_playing() or vc.is_paused():
+            return True
+        position = source.position
+        logging.warning(f"Stream for {source.resolved.title} ended at {position:.0f} of {source.resolved.duration} s ({error}), resuming")
+        resolved = await refresh_resolved(source.resolved, session.guild_id, force=True)
+        if not resolved or sessions.get(session.guild_id) is not session or not vc.is_connected():
+            return False
+        replacement = create_audio_source(resolved, session.volume, position)
+        replacement.recoveries = source.recoveries + 1
+        try:
+            start_source(interaction, session, vc, replacement)
+        except Exception as e:
+            logging.error(f"Stream recovery error: {e}")
+            replacement.cleanup()
+            return False
+        return True
+
+active_prebuffers = 0
+
+def discard_prebuffer(session):
+    global active_prebuffers
+    if session.prebuffer_timer:
+        session.prebuffer_timer.cancel()
+        session.prebuffer_timer = None
+    if session.prebuffer_task:
+        session.prebuffer_task.cancel()
+        session.prebuffer_task = None
+    if session.prebuffer:
+        session.prebuffer[1].cleanup()
+        session.prebuffer = None
+        active_prebuffers -= 1
+
+def schedule_prebuffer(session, source):
+    discard_prebuffer(session)
+    if not PREBUFFER_MAX or not source.resolved.duration:
+        return
+    delay = max(0.0, source.resolved.duration - source.position - PREBUFFER_LEAD)
+    session.prebuffer_timer = asyncio.get_running_loop().call_later(delay, start_prebuffer, session)
+
+def start_prebuffer(session):
+    session.prebuffer_timer = None
+    if sessions.get(session.guild_id) is session and session.queue:
+        session.prebuffer_task = asyncio.create_task(build_prebuffer(session, session.queue[0]))
+
+async def build_prebuffer(session, track):
+    global active_prebuffers
+    if active_prebuffers >= PREBUFFER_MAX:
+        return
+    active_prebuffers += 1
+    source = None
+    try:
+        resolved, _ = await resolve_queued_track(track, session.guild_id, PRIORITY_PREFETCH)
+        if resolved:
+            source = create_audio_source(resolved, session.volume)
+            await asyncio.get_running_loop().run_in_executor(None, source.prefill, PREBUFFER_FRAMES)
+    except BaseException:
+        if source:
+            source.cleanup()
+        active_prebuffers -= 1
+        raise
+    session.prebuffer_task = None
+    if source:
+        session.prebuffer = (track, source)
+        logging.info(f"Prebuffered next track: {source.resolved.title}")
+    else:
+        active_prebuffers -= 1
+
+def take_prebuffer(session, track):
+    global active_prebuffers
+    # Only usable if it was built for exactly this queue entry at the current volume
+    prebuffer = session.prebuffer
+    session.prebuffer = None
+    discard_prebuffer(session)
+    if not prebuffer:
+        return None
+    active_prebuffers -= 1
+    if prebuffer[0] is track and prebuffer[1].volume == session.volume:
+        return prebuffer[1]
+    prebuffer[1].cleanup()
+    return None
+
+def set_volume(session, vc, volume):
+    volume = round(volume, 2)
+    session.volume = volume
+    if session.journal:
+        session.journal.write_session()
+    source = vc.source
+    if isinstance(source, TrackedSource) and source.mode == 'opus':
+        # Opus output has the volume baked in by FFmpeg, so restart it at the current position
+        replace_source(session, vc, create_audio_source(source.resolved, volume, source.position))
+    else:
+        source.volume = volume
+    return volume
 
 async def play_next(interaction: discord.Interaction):
+    guild_id = interaction.guild.id
+    session = sessions.get(guild_id)
     vc = discord.utils.get(client.voice_clients, guild=interaction.guild)
-    if not vc or not queues.get(interaction.guild.id):
+    if not vc or not session or not session.queue:
         logging.info("No voice client or queue found, stopping playback.")
-        active_playback_guilds.discard(interaction.guild.id)
-        await client.change_presence(activity=discord.Activity(type=discord.ActivityType.playing, name=f"Playing music on {len(active_playback_guilds)} servers"))
+        if session and session.playing and not (vc and (vc.is_playing() or vc.is_paused())):
+            # The last track finished; without this the journal would resume it after a restart
+            session.playing = None
+            if session.journal:
+                session.journal.write_playing(None, 0.0)
+        active_playback_guilds.discard(guild_id)
+        presence_manager.changed()
         return
 
-    queue = queues[interaction.guild.id]
-    if queue and not vc.is_playing():
-        audio_url, title = queue.popleft()
-        current_track[interaction.guild.id] = title
-        current_track_url[interaction.guild.id] = audio_url
-        try:
-            logging.info(f"Attempting to play: {title} (URL: {audio_url})")
-            source = discord.FFmpegPCMAudio(audio_url, **FFMPEG_OPTIONS)
-            source = discord.PCMVolumeTransformer(source, volume=1.0)
-            vc.play(source, after=lambda e: asyncio.run_coroutine_threadsafe(play_next(interaction), client.loop))
-            logging.info(f"Successfully started playing: {title}")
-            active_playback_guilds.add(interaction.guild.id)
-            await client.change_presence(activity=discord.Activity(type=discord.ActivityType.playing, name=f"Playing music on {len(active_playback_guilds)} servers"))
-        except Exception as e:
-            logging.error(f"Playback error: {e}")
-            await interaction.followup.send(f"Playback error: {e}", ephemeral=True)
-    elif not queue:
-        logging.info("Queue is empty, stopping playback.")
-        active_playback_guilds.discard(interaction.guild.id)
-        await client.change_presence(activity=discord.Activity(type=discord.ActivityType.playing, name=f"Playing music on {len(active_playback_guilds)} servers"))
-        await interaction.followup.send("Queue is empty!", ephemeral=True)
-
-async def process_playlist(interaction: discord.Interaction, tracks, is_spotify=True, is_soundcloud=False):
-    queue = queues[interaction.guild.id]
-    for track in tracks:
-        if is_spotify:
-            audio_url, title = await get_youtube_url(track)
-        elif is_soundcloud:
-            audio_url, title = await get_soundcloud_url(track[0])
+    async with session.lock:
+        queue = session.queue
+        if vc.is_playing() or vc.is_paused():
+            return
+
+        failures = []
+        errors = set()
+        loads = set()
+        resolved = None
+        source = None
+        while queue and not resolved:
+            track = queue.popleft()
+            source = take_prebuffer(session, track)
+            if source:
+                resolved, error = source.resolved, None
+            else:
+                resolved, error = await resolve_queued_track(track, guild_id)
+            if track.playlist:
+                settle_track(track.playlist, resolved, track, error)
+                loads.add(track.playlist)
+            elif not resolved:
+                failures.append(track.title)
+                if error:
+                    errors.add(error)
+        if failures:
+            await send_failure_summary(interaction, failures, errors)
+        for load in loads:
+            await flush_playlist_failures(interaction, load, force=load.finished)
+        if sessions.get(guild_id) is not session or not vc.is_connected():
+            if source:
+                source.cleanup()
+            return
+
+        if resolved:
+            title = resolved.title
+            session.current_track = title
+            # A session restored from its journal resumes the interrupted track where it stopped
+            offset = session.resume_at
+            session.resume_at = 0.0
+            session.playing = track
+            if session.journal:
+                session.journal.write_playing(track, offset)
+            try:
+                logging.info(f"Attempting to play: {title}")
+                logging.debug(f"Stream URL for {title}: {resolved.stream_url}")
+                source = source or create_audio_source(resolved, session.volume, offset)
+                source.requested_at = session.play_requested_at
+                session.play_requested_at = None
+                start_source(interaction, session, vc, source)
+                logging.info(f"Successfully started playing: {title}")
+                active_playback_guilds.add(guild_id)
+                control_scheduler.mark_dirty(guild_id)
+                presence_manager.changed()
+                schedule_prefetch(session)
+                audio_cache.played(resolved, source.cached)
+            except Exception as e:
+                logging.error(f"Playback error: {e}")
+                if source and session.current_source is not source:
+                    # Never handed to the player, so nothing else would stop its FFmpeg
+                    source.cleanup()
+                await interaction.followup.send(f"Playback error: {e}", ephemeral=True)
         else:
-            audio_url, title = await get_youtube_url(track[0])
-        if audio_url:
-            queue.append((audio_url, title))
-            logging.info(f"Added to queue: {title}")
+            logging.info("Queue is empty, stopping playback.")
+            session.playing = None
+            if session.journal:
+                session.journal.write_playing(None, 0.0)
+            active_playback_guilds.discard(guild_id)
+            control_scheduler.mark_dirty(guild_id)
+            presence_manager.changed()
+            await interaction.followup.send("Queue is empty!", ephemeral=True)
+
+class DeadlineHeap:
+    def __init__(self, callback):
+        self.callback = callback
+        self.heap = []
+        self.deadlines = {}
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def schedule(self, key, delay):
+        deadline = time.monotonic() + delay
+        self.deadlines[key] = deadline
+        heapq.heappush(self.heap, (deadline, key))
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
         else:
-            if title:
-                await interaction.followup.send(title, ephemeral=True)
-            else:
-                await interaction.followup.send(f"Could not add track to queue: {track}", ephemeral=True)
-
-async def check_voice_channel(guild_id):
-    while guild_id in voice_check_tasks:
-        vc = discord.utils.get(client.voice_clients, guild=client.get_guild(guild_id))
-        if not vc:
-            if guild_id in voice_check_tasks:
-                del voice_check_tasks[guild_id]
-            break
-        voice_channel = vc.channel
-        members = voice_channel.members
-        human_members = [member for member in members if not member.bot]
-        if not human_members:
-            await vc.disconnect()
-            if guild_id in queues:
-                del queues[guild_id]
-            if guild_id in current_track:
-                del current_track[guild_id]
-            if guild_id in current_track_url:
-                del current_track_url[guild_id]
-            if guild_id in added_by:
-                del added_by[guild_id]
-            if guild_id in control_messages:
+            self.wakeup.set()
+
+    def cancel(self, key):
+        # Stale heap entries are skipped when they reach the top
+        self.deadlines.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    async def run(self):
+        while self.heap:
+            deadline, key = self.heap[0]
+            if self.deadlines.get(key) != deadline:
+                heapq.heappop(self.heap)
+                continue
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                self.wakeup.clear()
                 try:
-                    await control_messages[guild_id].delete()
-                except:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
                     pass
-                del control_messages[guild_id]
-            if guild_id in update_tasks:
-                update_tasks[guild_id].cancel()
-                del update_tasks[guild_id]
-            if guild_id in bot_owner:
-                del bot_owner[guild_id]
-            active_playback_guilds.discard(guild_id)
-            await client.change_presence(activity=discord.Activity(type=discord.ActivityType.playing, name=f"Playing music on {len(active_playback_guilds)} servers"))
-            logging.info(f"Bot left voice channel in guild {guild_id} due to no human members.")
-            break
-        await asyncio.sleep(10)
+                continue
+            heapq.heappop(self.heap)
+            del self.deadlines[key]
+            asyncio.create_task(self.callback(key))
+
+async def leave_guild(guild_id, delete_control_message=True):
+    leave_timers.cancel(guild_id)
+    # Dropping the session first makes the after= callback of the stopped track a no-op
+    session = sessions.pop(guild_id, None)
+    guild = client.get_guild(guild_id)
+    vc = guild.voice_client if guild else None
+    if vc:
+        await vc.disconnect()
+    if session:
+        session.close()
+        if delete_control_message and session.control_message:
+            try:
+                await session.control_message.delete()
+            except:
+                pass
+    active_playback_guilds.discard(guild_id)
+    presence_manager.changed()
+
+async def auto_leave(guild_id):
+    session = sessions.get(guild_id)
+    if session and session.human_count == 0:
+        await leave_guild(guild_id)
+        logging.info(f"Bot left voice channel in guild {guild_id} due to no human members.")
+
+leave_timers = DeadlineHeap(auto_leave)
+
+def count_humans(channel):
+    return sum(1 for member in channel.members if not member.bot)
+
+def update_leave_timer(session):
+    if session.human_count > 0:
+        leave_timers.cancel(session.guild_id)
+    elif session.guild_id not in leave_timers:
+        leave_timers.schedule(session.guild_id, AUTO_LEAVE_GRACE)
+
+class RestoredInteraction:
+    # Stands in for the /play interaction of a session restored after a restart; its followup messages are only logged
+    def __init__(self, guild):
+        self.guild = guild
+        self.followup = self
+
+    async def send(self, content=None, **kwargs):
+        logging.info(f"Restored session in guild {self.guild.id}: {content}")
+
+def journal_shard_id(guild_id):
+    return (guild_id >> 22) % SHARD_COUNT if SHARD_COUNT else 0
+
+async def restore_session(guild_id, path, semaphore):
+    guild = client.get_guild(guild_id)
+    session, voice_channel_id, text_channel_id = replay_journal(guild_id, path) if guild else (None, None, None)
+    voice_channel = guild.get_channel(voice_channel_id) if session else None
+    if guild_id in sessions:
+        # Someone started a new session before the restore got here; its journal already replaced this one
+        return False
+    if not voice_channel or not session.queue:
+        os.remove(path)
+        return False
+
+    async with semaphore:
+        try:
+            vc = await voice_channel.connect()
+        except (discord.ClientException, asyncio.TimeoutError) as e:
+            logging.error(f"Could not rejoin {voice_channel.name} in guild {guild_id}: {e}")
+            return False
+        if guild_id in sessions:
+            return False
+        sessions[guild_id] = session
+        session.human_count = count_humans(vc.channel)
+        session.current_track = session.queue[0].title
+        attach_journal(session, vc.channel.id, text_channel_id)
+        if session.journal:
+            session.journal.compact()
+        update_leave_timer(session)
+
+        text_channel = guild.get_channel(text_channel_id) if text_channel_id else None
+        if text_channel:
+            owner = guild.get_member(session.owner_id)
+            session.control_avatar = (owner or client.user).display_avatar.url
+            embed = render_control_embed(session)
+            try:
+                session.control_message = await text_channel.send("Resuming playback after a restart.", embed=embed, view=MusicControls())
+                control_scheduler.sent(session, embed)
+            except discord.HTTPException as e:
+                logging.error(f"Could not post the control message in guild {guild_id}: {e}")
+
+        # Only the first track is resolved here; prefetching picks up the rest as playback goes on
+        await play_next(RestoredInteraction(guild))
+    logging.info(f"Restored session in guild {guild_id} with {len(session.queue) + 1} tracks")
+    return True
+
+async def restore_sessions():
+    if not os.path.isdir(QUEUE_JOURNAL_DIR):
+        return
+    semaphore = asyncio.Semaphore(JOURNAL_RESTORE_CONCURRENCY)
+    restores = []
+    for name in os.listdir(QUEUE_JOURNAL_DIR):
+        guild_id = name.removesuffix('.jsonl')
+        if not name.endswith('.jsonl') or not guild_id.isdigit():
+            continue
+        guild_id = int(guild_id)
+        # Other workers restore the guilds on their own shards
+        if SHARD_IDS is not None and journal_shard_id(guild_id) not in SHARD_IDS:
+            continue
+        restores.append(restore_session(guild_id, os.path.join(QUEUE_JOURNAL_DIR, name), semaphore))
+    if not restores:
+        return
+    results = await asyncio.gather(*restores, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logging.error(f"Session restore error: {result}")
+    logging.info(f"Restored {sum(result is True for result in results)} of {len(restores)} journaled sessions")
+
+@client.event
+async def on_voice_state_update(member, before, after):
+    session = sessions.get(member.guild.id)
+    if not session or before.channel == after.channel:
+        return
+    if member.id == client.user.id:
+        if after.channel is None:
+            # Disconnected from outside the bot (kicked, channel deleted); on shutdown the session is kept for restore
+            if not client.is_closed():
+                await leave_guild(session.guild_id)
+        else:
+            session.human_count = count_humans(after.channel)
+            update_leave_timer(session)
+            if session.journal:
+                session.journal.voice_channel_id = after.channel.id
+                session.journal.write_session()
+        return
+    vc = member.guild.voice_client
+    if member.bot or not vc:
+        return
+    if before.channel == vc.channel:
+        session.human_count -= 1
+    if after.channel == vc.channel:
+        session.human_count += 1
+    update_leave_timer(session)
 
 @app_commands.command(name="play", description="Play a track or playlist by URL (Spotify, YouTube, YouTube Music, SoundCloud)")
 async def play(interaction: discord.Interaction, url: str):
+    requested_at = time.perf_counter()
     await interaction.response.defer(ephemeral=True)
 
     if not interaction.user.voice:
         await interaction.followup.send("You must be in a voice channel!", ephemeral=True)
         return
 
-    if interaction.guild.id in bot_owner:
-        if bot_owner[interaction.guild.id] != interaction.user.id:
-            await interaction.followup.send("The bot is currently being used by another user. Wait until they finish!", ephemeral=True)
-            return
+    session = sessions.get(interaction.guild.id)
+    if session and session.owner_id != interaction.user.id:
+        await interaction.followup.send("The bot is currently being used by another user. Wait until they finish!", ephemeral=True)
+        return
 
     voice_channel = interaction.user.voice.channel
     try:
@@ -300,143 +2194,193 @@ async def play(interaction: discord.Interaction, url: str):
         vc = discord.utils.get(client.voice_clients, guild=interaction.guild)
         logging.info("Bot is already connected to a voice channel.")
 
-    bot_owner[interaction.guild.id] = interaction.user.id
-
-    if interaction.guild.id not in queues:
-        queues[interaction.guild.id] = deque()
-
-    added_by[interaction.guild.id] = interaction.user.name
+    if not session:
+        session = sessions[interaction.guild.id] = GuildSession(interaction.guild.id, interaction.user.id)
+        session.human_count = count_humans(vc.channel)
+        attach_journal(session, vc.channel.id, interaction.channel_id)
+    session.added_by = interaction.user.name
+    if not vc.is_playing() and not vc.is_paused():
+        session.play_requested_at = requested_at
 
     try:
         if 'spotify.com/track' in url:
-            track_query = get_spotify_track_info(url)
-            audio_url, title = await get_youtube_url(track_query)
-            if not audio_url:
-                if title:
-                    await interaction.followup.send(title, ephemeral=True)
+            spotify_track = await get_spotify_track_info(url)
+            resolved, error = await resolve_spotify_track(spotify_track, interaction.guild.id)
+            if not resolved:
+                if error:
+                    await interaction.followup.send(error, ephemeral=True)
                 else:
                     await interaction.followup.send("Could not find the track on YouTube.", ephemeral=True)
                 return
-            queues[interaction.guild.id].append((audio_url, title))
-            current_track[interaction.guild.id] = title
-            current_track_url[interaction.guild.id] = audio_url
-
-        elif 'spotify.com/playlist' in url:
-            tracks = get_spotify_playlist_tracks(url)
-            await interaction.followup.send(f"Found a Spotify playlist with {len(tracks)} tracks. Starting processing...", ephemeral=True)
-            if not tracks:
-                await interaction.followup.send("The Spotify playlist is empty or inaccessible.", ephemeral=True)
-                return
-            audio_url, title = await get_youtube_url(tracks[0])
-            if not audio_url:
-                if title:
-                    await interaction.followup.send(title, ephemeral=True)
-                else:
-                    await interaction.followup.send("Could not find the first track on YouTube.", ephemeral=True)
-                return
-            queues[interaction.guild.id].append((audio_url, title))
-            current_track[interaction.guild.id] = title
-            current_track_url[interaction.guild.id] = audio_url
-            if len(tracks) > 1:
-                asyncio.create_task(process_playlist(interaction, tracks[1:], is_spotify=True))
-
-        elif 'youtube.com/playlist' in url or 'music.youtube.com/playlist' in url:
-            tracks = await get_youtube_playlist_urls(url)
-            if not tracks:
-                await interaction.followup.send("Could not find the YouTube playlist.", ephemeral=True)
-                return
-            audio_url, title = await get_youtube_url(tracks[0][0])
-            if not audio_url:
-                if title:
-                    await interaction.followup.send(title, ephemeral=True)
-                else:
-                    await interaction.followup.send("Could not find the first track of the YouTube playlist.", ephemeral=True)
+            session.queue.append(Track(spotify_query(spotify_track), resolved.title, 'youtube', spotify_track))
+            session.current_track = resolved.title
+
+        elif 'spotify.com/playlist' in url or 'youtube.com/playlist' in url or 'music.youtube.com/playlist' in url or ('soundcloud.com' in url and '/sets/' in url):
+            load = PlaylistLoad()
+            if 'spotify.com/playlist' in url:
+                provider_name = "Spotify"
+                pages = iter_spotify_playlist_pages(url, load)
+            elif 'soundcloud.com' in url:
+                provider_name = "SoundCloud"
+                pages = iter_soundcloud_playlist_pages(url, interaction.guild.id)
+            else:
+                provider_name = "YouTube"
+                pages = iter_youtube_playlist_pages(url, interaction.guild.id)
+            try:
+                first_page = await pages.__anext__()
+            except StopAsyncIteration:
+                first_page = None
+            if not first_page:
+                await pages.aclose()
+                await interaction.followup.send(f"The {provider_name} playlist is empty or inaccessible.", ephemeral=True)
                 return
-            queues[interaction.guild.id].append((audio_url, title))
-            current_track[interaction.guild.id] = title
-            current_track_url[interaction.guild.id] = audio_url
-            await interaction.followup.send(f"Found a YouTube playlist with {len(tracks)} tracks. Starting processing...", ephemeral=True)
-            if len(tracks) > 1:
-                asyncio.create_task(process_playlist(interaction, tracks[1:], is_spotify=False))
+            session.queue.extend(load.adopt(first_page))
+            session.current_track = first_page[0].title
+            session.playlist_load = load
+            await interaction.followup.send(f"Found a {provider_name} playlist ({load}). Starting playback, the rest is loading in the background...", ephemeral=True)
+            asyncio.create_task(ingest_playlist(interaction, pages, load))
 
         elif 'soundcloud.com' in url:
-            if '/sets/' in url:
-                tracks = await get_soundcloud_playlist_urls(url)
-                if not tracks:
-                    await interaction.followup.send("Could not find the playlist on SoundCloud.", ephemeral=True)
-                    return
-                audio_url, title = await get_soundcloud_url(tracks[0][0])
-                if not audio_url:
-                    await interaction.followup.send("Could not find the first track of the SoundCloud playlist.", ephemeral=True)
-                    return
-                queues[interaction.guild.id].append((audio_url, title))
-                current_track[interaction.guild.id] = title
-                current_track_url[interaction.guild.id] = audio_url
-                await interaction.followup.send(f"Found a SoundCloud playlist with {len(tracks)} tracks. Starting processing...", ephemeral=True)
-                if len(tracks) > 1:
-                    asyncio.create_task(process_playlist(interaction, tracks[1:], is_spotify=False, is_soundcloud=True))
-            else:
-                audio_url, title = await get_soundcloud_url(url)
-                if not audio_url:
-                    await interaction.followup.send("Could not find the track on SoundCloud.", ephemeral=True)
-                    return
-                queues[interaction.guild.id].append((audio_url, title))
-                current_track[interaction.guild.id] = title
-                current_track_url[interaction.guild.id] = audio_url
+            audio_url, title = await get_soundcloud_url(url, interaction.guild.id)
+            if not audio_url:
+                await interaction.followup.send("Could not find the track on SoundCloud.", ephemeral=True)
+                return
+            session.queue.append(Track(url, title, 'soundcloud'))
+            session.current_track = title
 
         else:
-            audio_url, title = await get_youtube_url(url)
+            audio_url, title = await get_youtube_url(url, interaction.guild.id)
             if not audio_url:
                 if title:
                     await interaction.followup.send(title, ephemeral=True)
                 else:
                     await interaction.followup.send("Could not find the track on YouTube.", ephemeral=True)
                 return
-            queues[interaction.guild.id].append((audio_url, title))
-            current_track[interaction.guild.id] = title
-            current_track_url[interaction.guild.id] = audio_url
+            session.queue.append(Track(url, title, 'youtube'))
+            session.current_track = title
 
-        embed = discord.Embed(title="Music Control", description=f"🎵 Now playing: **{current_track[interaction.guild.id]}**", color=discord.Color.blue())
-        embed.set_thumbnail(url=interaction.user.avatar.url if interaction.user.avatar else interaction.user.default_avatar.url)
-        embed.set_footer(text=f"In queue: {len(queues[interaction.guild.id])} tracks | Added by: {added_by[interaction.guild.id]}")
+        session.control_avatar = interaction.user.avatar.url if interaction.user.avatar else interaction.user.default_avatar.url
+        embed = render_control_embed(session)
 
         view = MusicControls()
-        message = await interaction.followup.send(embed=embed, view=view, ephemeral=True)
-        control_messages[interaction.guild.id] = message
-
-        user_avatar = interaction.user.avatar.url if interaction.user.avatar else interaction.user.default_avatar.url
-        update_task = asyncio.create_task(update_control_message(interaction.guild.id, user_avatar))
-        update_tasks[interaction.guild.id] = update_task
-
-        voice_check_task = asyncio.create_task(check_voice_channel(interaction.guild.id))
-        voice_check_tasks[interaction.guild.id] = voice_check_task
+        session.control_message = await interaction.followup.send(embed=embed, view=view, ephemeral=True)
+        control_scheduler.sent(session, embed)
 
         if not vc.is_playing():
             await play_next(interaction)
+        session.play_requested_at = None
 
     except Exception as e:
         logging.error(f"Playback error: {e}")
         await interaction.followup.send(f"Could not play: {e}", ephemeral=True)
 
+QUEUE_PAGE_SIZE = 10
+
+class QueuePositionModal(ui.Modal):
+    position = ui.TextInput(label="Position in queue", max_length=7)
+
+    def __init__(self, queue_view, action):
+        super().__init__(title="Jump to track" if action == 'jump' else "Remove track")
+        self.queue_view = queue_view
+        self.action = action
+
+    async def on_submit(self, interaction: discord.Interaction):
+        session = sessions.get(interaction.guild.id)
+        if not session or session.owner_id != interaction.user.id:
+            await interaction.response.send_message("Only the user who started the bot can control it!", ephemeral=True)
+            return
+        try:
+            index = int(self.position.value) - 1
+        except ValueError:
+            index = -1
+        if not 0 <= index < len(session.queue):
+            await interaction.response.send_message("There is no track at that position.", ephemeral=True)
+            return
+
+        if self.action == 'remove':
+            track = session.queue.remove(index)
+            drop_tracks([track])
+            message = f"Removed from the queue: {track.title}"
+        else:
+            drop_tracks(session.queue.slice(0, index))
+            session.queue.skip(index)
+            message = f"Jumping to: {session.queue[0].title}"
+        control_scheduler.mark_dirty(interaction.guild.id)
+        schedule_prefetch(session)
+        await self.queue_view.refresh(interaction)
+        await interaction.followup.send(message, ephemeral=True)
+
+        if self.action == 'jump':
+            vc = discord.utils.get(client.voice_clients, guild=interaction.guild)
+            if vc and (vc.is_playing() or vc.is_paused()):
+                if isinstance(vc.source, TrackedSource):
+                    vc.source.stopped = True
+                vc.stop()
+            await play_next(interaction)
+
+class QueueView(ui.View):
+    def __init__(self, guild_id):
+        super().__init__(timeout=300)
+        self.guild_id = guild_id
+        self.page = 0
+
+    def render(self, session):
+        # Only the visible page is formatted, so large queues cost the same as small ones
+        total = len(session.queue)
+        pages = max(1, -(-total // QUEUE_PAGE_SIZE))
+        self.page = min(self.page, pages - 1)
+        start = self.page * QUEUE_PAGE_SIZE
+        tracks = session.queue.slice(start, start + QUEUE_PAGE_SIZE)
+        self.prev_button.disabled = self.page == 0
+        self.next_button.disabled = self.page >= pages - 1
+        self.jump_button.disabled = self.remove_button.disabled = not tracks
+        if not tracks:
+            return "The queue is empty!"
+        lines = [f"{start + i + 1}. {track.title[:90]}" for i, track in enumerate(tracks)]
+        return f"Current queue (page {self.page + 1}/{pages}, {total} tracks):\n" + "\n".join(lines)
+
+    async def refresh(self, interaction: discord.Interaction):
+        session = sessions.get(self.guild_id)
+        if not session:
+            await interaction.response.edit_message(content="The queue is empty!", view=None)
+            return
+        await interaction.response.edit_message(content=self.render(session), view=self)
+
+    @ui.button(emoji="◀️", style=discord.ButtonStyle.grey)
+    async def prev_button(self, interaction: discord.Interaction, button: ui.Button):
+        self.page = max(0, self.page - 1)
+        await self.refresh(interaction)
+
+    @ui.button(emoji="▶️", style=discord.ButtonStyle.grey)
+    async def next_button(self, interaction: discord.Interaction, button: ui.Button):
+        self.page += 1
+        await self.refresh(interaction)
+
+    @ui.button(label="Jump to", style=discord.ButtonStyle.grey)
+    async def jump_button(self, interaction: discord.Interaction, button: ui.Button):
+        await interaction.response.send_modal(QueuePositionModal(self, 'jump'))
+
+    @ui.button(label="Remove", style=discord.ButtonStyle.grey)
+    async def remove_button(self, interaction: discord.Interaction, button: ui.Button):
+        await interaction.response.send_modal(QueuePositionModal(self, 'remove'))
+
 class MusicControls(ui.View):
     def __init__(self):
         super().__init__(timeout=None)
 
     async def interaction_check(self, interaction: discord.Interaction) -> bool:
         user_id = interaction.user.id
-        current_time = time.time()
-        last_press = last_button_press.get(user_id, 0)
 
-        if current_time - last_press < 1:
+        if not button_cooldowns.ready(user_id):
             await interaction.response.send_message("Wait 1 second before the next press!", ephemeral=True)
             return False
 
-        if interaction.guild.id in bot_owner:
-            if bot_owner[interaction.guild.id] != user_id:
-                await interaction.response.send_message("Only the user who started the bot can control it!", ephemeral=True)
-                return False
+        session = sessions.get(interaction.guild.id)
+        if session and session.owner_id != user_id:
+            await interaction.response.send_message("Only the user who started the bot can control it!", ephemeral=True)
+            return False
 
-        last_button_press[user_id] = current_time
+        button_cooldowns.touch(user_id)
         return True
 
     @ui.button(emoji="▶️", style=discord.ButtonStyle.grey)
@@ -461,6 +2405,8 @@ class MusicControls(ui.View):
     async def skip_button(self, interaction: discord.Interaction, button: ui.Button):
         vc = discord.utils.get(client.voice_clients, guild=interaction.guild)
         if vc and vc.is_playing():
+            if isinstance(vc.source, TrackedSource):
+                vc.source.stopped = True
             vc.stop()
             await interaction.response.send_message("Track skipped.", ephemeral=True)
             await play_next(interaction)
@@ -470,14 +2416,11 @@ class MusicControls(ui.View):
     @ui.button(emoji="🔁", style=discord.ButtonStyle.grey)
     async def restart_button(self, interaction: discord.Interaction, button: ui.Button):
         vc = discord.utils.get(client.voice_clients, guild=interaction.guild)
-        if vc and vc.is_playing() and interaction.guild.id in current_track_url:
-            vc.stop()
-            audio_url = current_track_url[interaction.guild.id]
-            title = current_track[interaction.guild.id]
-            source = discord.FFmpegPCMAudio(audio_url, **FFMPEG_OPTIONS)
-            source = discord.PCMVolumeTransformer(source, volume=vc.source.volume if vc.source else 1.0)
-            vc.play(source, after=lambda e: asyncio.run_coroutine_threadsafe(play_next(interaction), client.loop))
-            await interaction.response.send_message("The track has been restarted.", ephemeral=True)
+        session = sessions.get(interaction.guild.id)
+        if vc and vc.is_playing() and isinstance(vc.source, TrackedSource) and session:
+            await interaction.response.defer(ephemeral=True)
+            await seek_current(session, vc, 0.0)
+            await interaction.followup.send("The track has been restarted.", ephemeral=True)
         else:
             await interaction.response.send_message("Nothing is playing or the track is unavailable.", ephemeral=True)
 
@@ -487,45 +2430,32 @@ class MusicControls(ui.View):
 
     @ui.button(emoji="⏹️", style=discord.ButtonStyle.grey)
     async def clear_button(self, interaction: discord.Interaction, button: ui.Button):
-        if interaction.guild.id in queues:
-            queues[interaction.guild.id].clear()
+        session = sessions.get(interaction.guild.id)
+        if session:
+            drop_tracks(session.queue)
+            session.queue.clear()
+            control_scheduler.mark_dirty(interaction.guild.id)
+            if session.prefetch_task:
+                session.prefetch_task.cancel()
+            discard_prebuffer(session)
             await interaction.response.send_message("The queue has been cleared.", ephemeral=True)
         else:
             await interaction.response.send_message("The queue is already empty!", ephemeral=True)
 
     @ui.button(emoji="📜", style=discord.ButtonStyle.grey)
     async def queue_button(self, interaction: discord.Interaction, button: ui.Button):
-        if interaction.guild.id not in queues or not queues[interaction.guild.id]:
+        session = sessions.get(interaction.guild.id)
+        if not session or not session.queue:
             await interaction.response.send_message("The queue is empty!", ephemeral=True)
             return
-        queue_list = "\n".join([f"{i+1}. {title}" for i, (_, title) in enumerate(queues[interaction.guild.id])])
-        await interaction.response.send_message(f"Current queue:\n{queue_list}", ephemeral=True)
+        view = QueueView(interaction.guild.id)
+        await interaction.response.send_message(view.render(session), view=view, ephemeral=True)
 
     @ui.button(emoji="🚪", style=discord.ButtonStyle.grey)
     async def leave_button(self, interaction: discord.Interaction, button: ui.Button):
         vc = discord.utils.get(client.voice_clients, guild=interaction.guild)
         if vc:
-            await vc.disconnect()
-            if interaction.guild.id in queues:
-                del queues[interaction.guild.id]
-            if interaction.guild.id in current_track:
-                del current_track[interaction.guild.id]
-            if interaction.guild.id in current_track_url:
-                del current_track_url[interaction.guild.id]
-            if interaction.guild.id in added_by:
-                del added_by[interaction.guild.id]
-            if interaction.guild.id in control_messages:
-                del control_messages[interaction.guild.id]
-            if interaction.guild.id in update_tasks:
-                update_tasks[interaction.guild.id].cancel()
-                del update_tasks[interaction.guild.id]
-            if interaction.guild.id in voice_check_tasks:
-                voice_check_tasks[interaction.guild.id].cancel()
-                del voice_check_tasks[interaction.guild.id]
-            if interaction.guild.id in bot_owner:
-                del bot_owner[interaction.guild.id]
-            active_playback_guilds.discard(interaction.guild.id)
-            await client.change_presence(activity=discord.Activity(type=discord.ActivityType.playing, name=f"Playing music on {len(active_playback_guilds)} servers"))
+            await leave_guild(interaction.guild.id, delete_control_message=False)
             await interaction.response.send_message("The bot has left the channel.", ephemeral=True)
             await interaction.message.delete()
             self.stop()
@@ -535,10 +2465,9 @@ class MusicControls(ui.View):
     @ui.button(emoji="🔊", style=discord.ButtonStyle.grey)
     async def volume_up_button(self, interaction: discord.Interaction, button: ui.Button):
         vc = discord.utils.get(client.voice_clients, guild=interaction.guild)
-        if vc and vc.source:
-            current_volume = vc.source.volume
-            new_volume = min(current_volume + 0.1, 1.0)
-            vc.source.volume = new_volume
+        session = sessions.get(interaction.guild.id)
+        if vc and vc.source and session:
+            new_volume = set_volume(session, vc, min(vc.source.volume + 0.1, 1.0))
             await interaction.response.send_message(f"The volume has been increased to {int(new_volume * 100)}%.", ephemeral=True)
         else:
             await interaction.response.send_message("The bot is not in the voice channel or playing anything!", ephemeral=True)
@@ -546,18 +2475,60 @@ class MusicControls(ui.View):
     @ui.button(emoji="🔉", style=discord.ButtonStyle.grey)
     async def volume_down_button(self, interaction: discord.Interaction, button: ui.Button):
         vc = discord.utils.get(client.voice_clients, guild=interaction.guild)
-        if vc and vc.source:
-            current_volume = vc.source.volume
-            new_volume = max(current_volume - 0.1, 0.0)
-            vc.source.volume = new_volume
+        session = sessions.get(interaction.guild.id)
+        if vc and vc.source and session:
+            new_volume = set_volume(session, vc, max(vc.source.volume - 0.1, 0.0))
             await interaction.response.send_message(f"The volume has been reduced to {int(new_volume * 100)}%.", ephemeral=True)
         else:
             await interaction.response.send_message("The bot is not in the voice channel or playing anything!", ephemeral=True)
 
+def parse_position(text):
+    # Accepts plain seconds or m:ss / h:mm:ss; every part must be a finite, non-negative number
+    try:
+        seconds = 0.0
+        for part in text.strip().split(':'):
+            value = float(part)
+            if not math.isfinite(value) or value < 0:
+                return None
+            seconds = seconds * 60 + value
+    except ValueError:
+        return None
+    return seconds
+
+def format_position(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+@app_commands.command(name="seek", description="Jump to a position in the current track (seconds or m:ss)")
+async def seek(interaction: discord.Interaction, position: str):
+    session = sessions.get(interaction.guild.id)
+    vc = discord.utils.get(client.voice_clients, guild=interaction.guild)
+    if not session or not vc or not isinstance(vc.source, TrackedSource):
+        await interaction.response.send_message("Nothing's playing right now.", ephemeral=True)
+        return
+    if session.owner_id != interaction.user.id:
+        await interaction.response.send_message("Only the user who started the bot can control it!", ephemeral=True)
+        return
+    seconds = parse_position(position)
+    if seconds is None:
+        await interaction.response.send_message("Invalid position. Use seconds or m:ss, for example `90` or `1:30`.", ephemeral=True)
+        return
+    duration = vc.source.resolved.duration
+    if duration and seconds >= duration:
+        await interaction.response.send_message(f"The track is only {format_position(duration)} long.", ephemeral=True)
+        return
+    await interaction.response.defer(ephemeral=True)
+    await seek_current(session, vc, seconds)
+    await interaction.followup.send(f"Jumped to {format_position(seconds)}.", ephemeral=True)
+
 # Register the command
 tree.add_command(play)
+tree.add_command(seek)
 
-try:
-    client.run(token)
-except Exception as e:
-    logging.error(f"Bot startup error: {e}")
+# Guarded so that spawned extraction worker processes can import this module without starting the bot
+if __name__ == '__main__':
+    try:
+        client.run(token)
+    except Exception as e:
+        logging.error(f"Bot startup error: {e}")
@@ -0,0 +1,214 @@
+import sys
+import time
+import asyncio
+import logging
+import threading
+from collections import Counter as StackCounter
+from aiohttp import web
+
+# Minimal Prometheus text-format metrics, served by serve() on a local HTTP port
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def samples(self):
+        return [(self.name, key, (), value) for key, value in sorted(self.values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, extra, value in self.samples():
+            lines.append(f"{name}{format_labels(self.labels, key, extra)} {value}")
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), collect=None):
+        super().__init__(name, documentation, labels)
+        # collect() returns {label values tuple: value}, read at scrape time
+        self.collect = collect
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+    def samples(self):
+        if self.collect:
+            self.values = self.collect()
+        return super().samples()
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+        series[1] += value
+        series[2] += 1
+
+    def time(self, **labels):
+        return HistogramTimer(self, labels)
+
+    def samples(self):
+        samples = []
+        for key, (counts, total, count) in sorted(self.values.items()):
+            for bound, bucket_count in zip(self.buckets, counts):
+                samples.append((f"{self.name}_bucket", key, (('le', bound),), bucket_count))
+            samples.append((f"{self.name}_bucket", key, (('le', '+Inf'),), count))
+            samples.append((f"{self.name}_sum", key, (), total))
+            samples.append((f"{self.name}_count", key, (), count))
+        return samples
+
+class HistogramTimer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logging.error(f"Error collecting metric {metric.name}: {e}")
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+def counter(name, documentation, labels=()):
+    return registry.register(Counter(name, documentation, labels))
+
+def gauge(name, documentation, labels=(), collect=None):
+    return registry.register(Gauge(name, documentation, labels, collect))
+
+def histogram(name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+    return registry.register(Histogram(name, documentation, labels, buckets))
+
+class RateLimitLogHandler(logging.Handler):
+    # discord.py handles 429 responses internally and only logs them, so they are counted from its log records.
+    # Attach it to discord.http (REST) and discord.webhook.async_ (interaction followups and their edits).
+    # A global 429 also logs "Global rate limit has been hit", which is not counted again
+    def __init__(self, counter):
+        super().__init__(logging.WARNING)
+        self.counter = counter
+
+    def emit(self, record):
+        message = str(record.msg)
+        if message.startswith('We are being rate limited'):
+            self.counter.inc(scope='rest')
+        elif message.startswith('Webhook ID') and 'is rate limited' in message:
+            self.counter.inc(scope='webhook')
+
+class SamplingProfiler:
+    # Samples the stacks of all threads at a fixed interval and reports them in collapsed (flame graph) format
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.stacks = StackCounter()
+        self.running = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stacks.clear()
+        self.running.set()
+        self.thread = threading.Thread(target=self.sample, name='profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        self.thread.join()
+        self.thread = None
+        return '\n'.join(f"{stack} {count}" for stack, count in self.stacks.most_common()) + '\n'
+
+    def sample(self):
+        own_id = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        while self.running.is_set():
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{frame.f_code.co_name} ({frame.f_code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.stacks[';'.join([names.get(thread_id, str(thread_id)), *reversed(stack)])] += 1
+            time.sleep(self.interval)
+
+profiler_lock = asyncio.Lock()
+
+async def handle_metrics(request):
+    return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8')
+
+async def handle_profile(request):
+    try:
+        seconds = min(120.0, max(1.0, float(request.query.get('seconds', '30'))))
+    except ValueError:
+        return web.Response(status=400, text="seconds must be a number\n")
+    if profiler_lock.locked():
+        return web.Response(status=409, text="A profile is already running\n")
+    async with profiler_lock:
+        profiler = SamplingProfiler()
+        profiler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            result = profiler.stop()
+    return web.Response(text=result, content_type='text/plain')
+
+async def serve(host, port, profiling=False):
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    if profiling:
+        app.router.add_get('/profile', handle_profile)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Metrics available at http://{host}:{port}/metrics" + (" (profiling at /profile)" if profiling else ""))
+    return runner
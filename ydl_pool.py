@@ -0,0 +1,177 @@
+import os
+import sys
+import queue
+import atexit
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+yt_dlp = None
+yt_dlp_lock = threading.Lock()
+
+def load_yt_dlp():
+    # yt-dlp takes a while to import, so it is loaded on the first extraction instead of at startup
+    global yt_dlp
+    if yt_dlp is None:
+        with yt_dlp_lock:
+            if yt_dlp is None:
+                import yt_dlp as module
+                # Suppress warnings from yt-dlp and set custom headers
+                module.utils.std_headers['User-Agent'] = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36'
+                module.utils.std_headers['Accept-Language'] = 'en-US,en;q=0.9'
+                module.utils.std_headers['Accept'] = 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8'
+                module.utils.std_headers['Referer'] = 'https://www.youtube.com/'
+                yt_dlp = module
+    return yt_dlp
+
+# Only these fields are read by the bot; dropping the rest keeps results cheap to send between processes
+INFO_FIELDS = ('id', 'title', 'url', 'duration', 'webpage_url', 'acodec', 'ext')
+
+pool_size = 2
+pools = {}
+pools_lock = threading.Lock()
+close_registered = False
+
+class ExtractionError(Exception):
+    pass
+
+class YoutubeDLPool:
+    # Instances are handed out as (generation, ydl); replacing the cookie file starts a new generation
+    def __init__(self, options, size):
+        self.options = options
+        self.size = size
+        self.created = 0
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.cookiefile = options.get('cookiefile')
+        self.cookie_mtime = self.read_cookie_mtime()
+        self.generation = 0
+
+    def read_cookie_mtime(self):
+        try:
+            return os.stat(self.cookiefile).st_mtime_ns if self.cookiefile else None
+        except OSError:
+            return None
+
+    def create(self):
+        global close_registered
+        if not close_registered:
+            close_registered = True
+            atexit.register(close_all)
+        # Each instance gets its own copy of the options, which extract_info adjusts per call
+        return self.generation, load_yt_dlp().YoutubeDL(dict(self.options))
+
+    def acquire(self):
+        self.check_cookies()
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.created < self.size:
+                self.created += 1
+                return self.create()
+        return self.idle.get()
+
+    def release(self, generation, ydl):
+        if generation != self.generation:
+            discard(ydl)
+            # Someone may be waiting for an idle instance, so the stale one is replaced right away
+            with self.lock:
+                replacement = self.create()
+            self.idle.put(replacement)
+            return
+        self.idle.put((generation, ydl))
+
+    def check_cookies(self):
+        # A rotated cookie file is picked up by recreating the instances, which otherwise only read it once
+        mtime = self.read_cookie_mtime()
+        if mtime == self.cookie_mtime:
+            return
+        with self.lock:
+            if mtime == self.cookie_mtime:
+                return
+            self.cookie_mtime = mtime
+            self.generation += 1
+            stale = self.drain()
+            self.created -= len(stale)
+        for _, ydl in stale:
+            discard(ydl)
+
+    def drain(self):
+        drained = []
+        while True:
+            try:
+                drained.append(self.idle.get_nowait())
+            except queue.Empty:
+                return drained
+
+    def close(self):
+        # Saves each instance's cookies back to the cookie file
+        with self.lock:
+            idle = self.drain()
+            self.created -= len(idle)
+        for generation, ydl in idle:
+            discard(ydl, save=generation == self.generation)
+
+def discard(ydl, save=False):
+    if not save:
+        # Instances from before a cookie rotation must not write their old cookies over the new file
+        ydl.params['cookiefile'] = None
+    try:
+        ydl.close()
+    except Exception:
+        pass
+
+def close_all():
+    for pool in list(pools.values()):
+        pool.close()
+
+def configure(size):
+    global pool_size
+    pool_size = max(1, size)
+
+def get_pool(name, options):
+    pool = pools.get(name)
+    if pool is None:
+        with pools_lock:
+            pool = pools.get(name)
+            if pool is None:
+                pool = pools[name] = YoutubeDLPool(options, pool_size)
+    return pool
+
+def trim_info(info):
+    if not info:
+        return info
+    trimmed = {field: info[field] for field in INFO_FIELDS if field in info}
+    if info.get('entries') is not None:
+        trimmed['entries'] = [trim_info(entry) for entry in info['entries'] if entry]
+    return trimmed
+
+def extract_info(name, options, url, playlist_items=None):
+    pool = get_pool(name, options)
+    generation, ydl = pool.acquire()
+    try:
+        # Playlists are read in windows such as '101-200'
+        ydl.params['playlist_items'] = playlist_items
+        return trim_info(ydl.extract_info(url, download=False))
+    except Exception as e:
+        # yt-dlp exceptions do not always survive pickling, so only the message crosses the process boundary
+        raise ExtractionError(str(e)) from None
+    finally:
+        pool.release(generation, ydl)
+
+def start_process_pool(workers):
+    # Spawned children re-import the parent's __main__ before running anything. Pointing __main__ at this
+    # module while they start makes them import only ydl_pool instead of re-running all of main.py
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'), initializer=configure, initargs=(1,))
+    main_module = sys.modules['__main__']
+    main_spec = getattr(main_module, '__spec__', None)
+    main_module.__spec__ = sys.modules[__name__].__spec__
+    try:
+        # Workers are only started on submit, so start all of them now
+        for _ in range(workers):
+            executor.submit(os.getpid)
+    finally:
+        main_module.__spec__ = main_spec
+    return executor